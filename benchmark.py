@@ -0,0 +1,341 @@
+#! /usr/bin/env python3
+
+# benchmark.py
+"""Offline throughput benchmark.
+
+Starts a local stub DNS server loaded with synthetic zones (deep SPF include trees, redirects,
+missing DMARC, BIMI, subdomains) and runs the scanning engines against it. Every size runs in
+its own process so caches and peak RSS are measured from scratch.
+
+    python3 benchmark.py --sizes 1000 10000 100000 --engine thread -t 16
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+import spoofy
+from modules import dkim, resolver
+
+STUB_ADDRESS = "127.0.0.1"
+TTL = 300
+
+
+class StubDNSServer:
+    """Minimal authoritative UDP server answering from an in-memory zone table.
+
+    It runs in a forked process so that it doesn't compete with the scanner for the GIL. Names in
+    `failing` are answered with SERVFAIL, as an overloaded server does.
+    """
+
+    def __init__(self, records, port=0, address=STUB_ADDRESS, failing=()):
+        self.records = records
+        self.names = {name for name, _ in records}
+        self.failing = set(failing)
+        self.query_count = multiprocessing.get_context("fork").Value("L", 0)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.socket.bind((address, port))
+        self.port = self.socket.getsockname()[1]
+        self.process = multiprocessing.get_context("fork").Process(
+            target=self.serve, daemon=True
+        )
+
+    @property
+    def queries(self):
+        return self.query_count.value
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.socket.close()
+
+    def serve(self):
+        while True:
+            data, address = self.socket.recvfrom(4096)
+            with self.query_count.get_lock():
+                self.query_count.value += 1
+            try:
+                query = dns.message.from_wire(data)
+            except dns.exception.DNSException:
+                continue
+            self.socket.sendto(self.answer(query).to_wire(), address)
+
+    def answer(self, query):
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        name = question.name.to_text(omit_final_dot=True).lower()
+        rdtype = dns.rdatatype.to_text(question.rdtype)
+        values = self.records.get((name, rdtype))
+        if name in self.failing:
+            response.set_rcode(dns.rcode.SERVFAIL)
+        elif values:
+            response.answer.append(
+                dns.rrset.from_text(question.name, TTL, "IN", rdtype, *values)
+            )
+        elif name not in self.names:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        return response
+
+
+def build_zones(size, seed=0):
+    """Returns (records, domains) for a synthetic population of `size` input domains."""
+    rng = random.Random(seed)
+    records = {("ns1.stub-dns.net", "A"): [STUB_ADDRESS]}
+
+    def txt(name, value):
+        records.setdefault((name, "TXT"), []).append(f'"{value}"')
+
+    # Shared providers with include trees three levels deep, as large mail providers publish.
+    providers = []
+    for p in range(20):
+        base = f"provider{p}.net"
+        leaves = [f"_spf{i}.{base}" for i in range(3)]
+        for leaf in leaves:
+            txt(leaf, f"v=spf1 ip4:192.0.2.{p} ip4:198.51.100.{p} -all")
+        txt(
+            f"_netblocks.{base}",
+            "v=spf1 " + " ".join(f"include:{leaf}" for leaf in leaves) + " ~all",
+        )
+        txt(f"_spf.{base}", f"v=spf1 include:_netblocks.{base} ~all")
+        providers.append(f"_spf.{base}")
+
+    domains = []
+    organizations = []
+    for i in range(size):
+        if organizations and rng.random() < 0.2:
+            # Subdomain of an earlier domain; shares its organizational DMARC record.
+            domain = f"mail{i}.{rng.choice(organizations)}"
+            records.setdefault((domain, "A"), [STUB_ADDRESS])
+            domains.append(domain)
+            continue
+
+        domain = f"bench-{i:07d}.com"
+        domains.append(domain)
+        organizations.append(domain)
+        records[(domain, "SOA")] = [
+            f"ns1.stub-dns.net. hostmaster.{domain}. 1 7200 3600 1209600 {TTL}"
+        ]
+
+        shape = rng.random()
+        all_mechanism = rng.choice(["-all", "~all", "?all", "+all"])
+        if shape < 0.6:
+            includes = " ".join(
+                f"include:{p}" for p in rng.sample(providers, rng.randint(1, 3))
+            )
+            txt(domain, f"v=spf1 mx a {includes} {all_mechanism}")
+        elif shape < 0.7:
+            txt(domain, f"v=spf1 redirect={rng.choice(providers)}")
+        elif shape < 0.85:
+            txt(domain, f"v=spf1 ip4:203.0.113.{i % 256} {all_mechanism}")
+        else:
+            txt(domain, "google-site-verification=stub")  # TXT but no SPF
+
+        if rng.random() < 0.65:
+            policy = rng.choice(["none", "quarantine", "reject"])
+            subdomain_policy = rng.choice(["none", "quarantine", "reject"])
+            txt(
+                f"_dmarc.{domain}",
+                f"v=DMARC1; p={policy}; sp={subdomain_policy}; aspf={rng.choice('rs')}; "
+                f"pct={rng.choice([100, 100, 50])}; rua=mailto:dmarc@{domain}",
+            )
+        if i % 3 == 0:
+            for selector in ("selector1", "google"):
+                txt(
+                    f"{selector}._domainkey.{domain}",
+                    "v=DKIM1; k=rsa; p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQC",
+                )
+        if rng.random() < 0.1:
+            txt(
+                f"default._bimi.{domain}",
+                f"v=BIMI1; l=https://{domain}/logo.svg; a=https://{domain}/vmc.pem",
+            )
+
+    return records, domains
+
+
+class CollectingWriter:
+    def __init__(self):
+        self.count = 0
+
+    def write(self, result):
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+def run_size(size, engine, threads, concurrency, dkim_probe=False, group_window=0):
+    """Benchmarks one input size in this process and returns its measurements."""
+    records, domains = build_zones(size)
+    server = StubDNSServer(records).start()
+    resolver.configure(nameservers=[STUB_ADDRESS], port=server.port, lifetime=2.0)
+    if dkim_probe:
+        dkim.configure(use_api=False, selectors=dkim.DEFAULT_SELECTORS)
+
+    latencies = []
+    process_domain = spoofy.process_domain
+    process_domain_async = spoofy.process_domain_async
+
+    def timed_process_domain(domain, enable_dkim=False, metrics=None):
+        start = time.perf_counter()
+        result = process_domain(domain, enable_dkim, metrics)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    async def timed_process_domain_async(domain, enable_dkim=False, metrics=None):
+        start = time.perf_counter()
+        result = await process_domain_async(domain, enable_dkim, metrics)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    spoofy.process_domain = timed_process_domain
+    spoofy.process_domain_async = timed_process_domain_async
+
+    writer = CollectingWriter()
+    start = time.perf_counter()
+    if engine == "async":
+        asyncio.run(
+            spoofy.run_async(
+                iter(domains),
+                writer,
+                dkim_probe,
+                concurrency=concurrency,
+                group_window=group_window,
+            )
+        )
+    else:
+        spoofy.run_threads(
+            iter(domains),
+            writer,
+            dkim_probe,
+            thread_count=threads,
+            group_window=group_window,
+        )
+    elapsed = time.perf_counter() - start
+    server.stop()
+    # Unix only; imported here so that the stub server can be imported on any platform.
+    import resource
+
+    quantiles = (
+        statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    )
+    return {
+        "domains": writer.count,
+        "seconds": round(elapsed, 3),
+        "domains_per_second": round(writer.count / elapsed, 1),
+        "queries_per_domain": round(server.queries / writer.count, 2),
+        "lookups_per_domain": round(resolver.totals.lookups / writer.count, 2),
+        "p50_ms": round(quantiles[49] * 1000, 2),
+        "p99_ms": round(quantiles[98] * 1000, 2),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Spoofy against a local stub DNS server."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--engine", choices=["thread", "async"], default="thread")
+    parser.add_argument(
+        "-t", type=int, default=16, help="Threads for the thread engine (default: 16)."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1000,
+        help="Domains in flight for the async engine (default: 1000).",
+    )
+    parser.add_argument(
+        "--dkim-probe",
+        action="store_true",
+        help="Also probe the built-in DKIM selectors over DNS.",
+    )
+    parser.add_argument(
+        "--group-window",
+        type=int,
+        default=spoofy.DEFAULT_GROUP_WINDOW,
+        help=f"Domains grouped by organization at a time, 0 to keep the input order (default: {spoofy.DEFAULT_GROUP_WINDOW}).",
+    )
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(
+            json.dumps(
+                run_size(
+                    args.sizes[0],
+                    args.engine,
+                    args.t,
+                    args.concurrency,
+                    args.dkim_probe,
+                    args.group_window,
+                )
+            )
+        )
+        return
+
+    columns = [
+        "domains",
+        "seconds",
+        "domains_per_second",
+        "queries_per_domain",
+        "lookups_per_domain",
+        "p50_ms",
+        "p99_ms",
+        "peak_rss_mb",
+    ]
+    print(
+        f"engine={args.engine} threads={args.t} concurrency={args.concurrency} "
+        f"dkim_probe={args.dkim_probe} group_window={args.group_window}"
+    )
+    print(" ".join(f"{column:>18}" for column in columns))
+    for size in args.sizes:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--single",
+                "--sizes",
+                str(size),
+                "--engine",
+                args.engine,
+                "-t",
+                str(args.t),
+                "--concurrency",
+                str(args.concurrency),
+                "--group-window",
+                str(args.group_window),
+                *(["--dkim-probe"] if args.dkim_probe else []),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(" ".join(f"{result[column]:>18}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
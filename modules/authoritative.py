@@ -0,0 +1,112 @@
+# modules/authoritative.py
+
+import asyncio
+import threading
+
+import dns.exception
+import dns.resolver
+
+from .resolver import register_zone_servers, resolve, resolve_async
+from .tld import get_registered_domain
+
+_settings = {"enabled": False}
+# Addresses of the authoritative servers of each name looked up, keyed by name. Names below a
+# zone cut share the tuple of their zone, so a zone's NS records are resolved once per run.
+_zones = {}
+_zones_lock = threading.Lock()
+# Failures of a lookup; anything else is a bug and is raised.
+LOOKUP_ERRORS = (dns.exception.DNSException, OSError)
+
+
+def configure(enabled=None):
+    """Turns authoritative mode on or off: records are asked of each zone's own servers."""
+    if enabled is not None:
+        _settings["enabled"] = enabled
+
+
+def is_enabled():
+    return _settings["enabled"]
+
+
+def get_zone_names(domain):
+    """Returns the names a domain's zone may be rooted at, from the domain up to its registered domain."""
+    labels = domain.rstrip(".").lower().split(".")
+    registered_domain = get_registered_domain(domain)
+    names = []
+    for index in range(len(labels)):
+        name = ".".join(labels[index:])
+        names.append(name)
+        if name == registered_domain:
+            break
+    return names if registered_domain else names[:1]
+
+
+def _save_zone(names, addresses, zone=None):
+    addresses = tuple(addresses) or None
+    with _zones_lock:
+        for name in names:
+            _zones[name] = addresses
+    if addresses and zone:
+        register_zone_servers(zone, addresses)
+    return addresses
+
+
+def get_zone_servers(domain):
+    """Returns the addresses of the authoritative servers of the zone a domain belongs to, or None.
+
+    The zone is found by walking up from the domain until a name has NS records; the NS lookups go
+    to the recursive resolvers.
+    """
+    walked = []
+    for name in get_zone_names(domain):
+        with _zones_lock:
+            cached = name in _zones
+            addresses = _zones.get(name)
+        if cached:
+            return _save_zone(walked, addresses or ())
+        walked.append(name)
+        try:
+            answer = resolve(name, "NS")
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            continue
+        except LOOKUP_ERRORS:
+            return None
+        addresses = []
+        for host in sorted(str(record.target) for record in answer):
+            try:
+                addresses.extend(str(address) for address in resolve(host, "A"))
+            except LOOKUP_ERRORS:
+                continue
+        return _save_zone(walked, dict.fromkeys(addresses), name)
+    return _save_zone(walked, ())
+
+
+async def get_zone_servers_async(domain):
+    """Async counterpart of get_zone_servers. The NS hosts are resolved concurrently."""
+    walked = []
+    for name in get_zone_names(domain):
+        with _zones_lock:
+            cached = name in _zones
+            addresses = _zones.get(name)
+        if cached:
+            return _save_zone(walked, addresses or ())
+        walked.append(name)
+        try:
+            answer = await resolve_async(name, "NS")
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            continue
+        except LOOKUP_ERRORS:
+            return None
+        hosts = sorted(str(record.target) for record in answer)
+        answers = await asyncio.gather(
+            *(resolve_async(host, "A") for host in hosts), return_exceptions=True
+        )
+        addresses = []
+        for host_answer in answers:
+            if isinstance(host_answer, LOOKUP_ERRORS):
+                continue
+            if isinstance(host_answer, BaseException):
+                raise host_answer
+            addresses.extend(str(address) for address in host_answer)
+        return _save_zone(walked, dict.fromkeys(addresses), name)
+    return _save_zone(walked, ())
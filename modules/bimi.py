@@ -1,13 +1,37 @@
 # modules/bimi.py
 
-import dns.resolver
+from .resolver import resolve, resolve_async, time_stage
+from .syntax import parse_tags
 
 
 class BIMI:
     def __init__(self, domain, dns_server=None):
         self.domain = domain
         self.dns_server = dns_server
-        self.bimi_record = self.get_bimi_record()
+        with time_stage("bimi"):
+            self.load(self.get_bimi_record())
+
+    @classmethod
+    def from_record(cls, domain, bimi_record, dns_server=None):
+        """Builds a BIMI object from an already fetched record."""
+        bimi = cls.__new__(cls)
+        bimi.domain = domain
+        bimi.dns_server = dns_server
+        bimi.load(bimi_record)
+        return bimi
+
+    @classmethod
+    async def create_async(cls, domain, dns_server=None):
+        """Async counterpart of BIMI(domain, dns_server)."""
+        bimi = cls.from_record(domain, None, dns_server)
+        with time_stage("bimi"):
+            bimi.load(await bimi.get_bimi_record_async())
+        return bimi
+
+    def load(self, bimi_record):
+        """Sets the BIMI record and the tags parsed from it."""
+        self.bimi_record = bimi_record
+        self.tags = parse_tags(bimi_record) if bimi_record else {}
         self.version = None
         self.location = None
         self.authority = None
@@ -20,34 +44,42 @@ class BIMI:
     def get_bimi_record(self):
         """Returns the BIMI record for the domain."""
         try:
-            resolver = dns.resolver.Resolver()
-            if self.dns_server:
-                resolver.nameservers = [self.dns_server]
-            bimi = resolver.resolve(f"default._bimi.{self.domain}", "TXT")
-            for record in bimi:
-                if "v=BIMI" in str(record):
-                    return record
+            nameservers = [self.dns_server] if self.dns_server else None
+            bimi = resolve(f"default._bimi.{self.domain}", "TXT", nameservers)
+        except Exception:
             return None
+        return self.bimi_record_from_answer(bimi)
+
+    async def get_bimi_record_async(self):
+        """Async counterpart of get_bimi_record."""
+        try:
+            nameservers = [self.dns_server] if self.dns_server else None
+            bimi = await resolve_async(
+                f"default._bimi.{self.domain}", "TXT", nameservers
+            )
         except Exception:
             return None
+        return self.bimi_record_from_answer(bimi)
+
+    @staticmethod
+    def bimi_record_from_answer(bimi):
+        """Returns the BIMI record among the TXT records of an answer, or None."""
+        for record in bimi:
+            if "v=BIMI" in str(record):
+                return str(record).replace('"', "")
+        return None
 
     def get_bimi_version(self):
         """Returns the version value from a BIMI record."""
-        if "v=" in str(self.bimi_record):
-            return str(self.bimi_record).split("v=")[1].split(";")[0]
-        return None
+        return self.tags.get("v")
 
     def get_bimi_location(self):
         """Returns the location value from a BIMI record."""
-        if "l=" in str(self.bimi_record):
-            return str(self.bimi_record).split("l=")[1].split(";")[0]
-        return None
+        return self.tags.get("l")
 
     def get_bimi_authority(self):
         """Returns the authority value from a BIMI record."""
-        if "a=" in str(self.bimi_record):
-            return str(self.bimi_record).split("a=")[1].split(";")[0]
-        return None
+        return self.tags.get("a")
 
     def get_bimi_details(self):
         """Returns a tuple containing version, location, and authority from a BIMI record."""
@@ -1,41 +1,289 @@
 # modules/dkim.py
 
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import dns.exception
 import requests
+from requests.adapters import HTTPAdapter
+
+from .resolver import resolve, time_stage
+from .syntax import parse_tags
+
+DEFAULT_API_BASE_URL = "https://archive.prove.email/api"
+DEFAULT_API_RATE = 10.0
+DEFAULT_API_RETRIES = 3
+DEFAULT_API_BACKOFF = 1.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RESPONSE_CACHE_SIZE = 10000
+
+# Selectors commonly published by mail providers and DKIM signing software.
+DEFAULT_SELECTORS = [
+    "default",
+    "dkim",
+    "mail",
+    "selector1",
+    "selector2",
+    "google",
+    "k1",
+    "k2",
+    "k3",
+    "s1",
+    "s2",
+    "key1",
+    "key2",
+    "dk",
+    "smtp",
+    "sig1",
+    "mandrill",
+    "mxvault",
+    "everlytickey1",
+    "everlytickey2",
+    "pm",
+    "mailjet",
+    "zoho",
+    "fm1",
+    "fm2",
+    "fm3",
+    "protonmail",
+    "protonmail2",
+    "protonmail3",
+    "turbo-smtp",
+]
+DEFAULT_MAX_SELECTORS = 5
+DEFAULT_PROBE_WORKERS = 32
+
+
+class TokenBucket:
+    """Lets at most `rate` calls per second through, with bursts of up to `capacity` calls."""
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class DKIMClient:
+    """Client for the DKIM key archive API, shared by every domain of a run.
+
+    Requests go through one pooled session and a rate limiter, rate limited and failed requests
+    are retried with exponential backoff, and responses are cached per domain.
+    """
+
+    def __init__(
+        self,
+        api_base_url=DEFAULT_API_BASE_URL,
+        rate=DEFAULT_API_RATE,
+        retries=DEFAULT_API_RETRIES,
+        backoff=DEFAULT_API_BACKOFF,
+        timeout=10,
+        pool_size=32,
+    ):
+        self.url = f"{api_base_url.rstrip('/')}/key"
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(rate)
+        self.session = requests.Session()
+        self.session.headers["accept"] = "application/json"
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_keys(self, domain):
+        """Returns the decoded API response listing the DKIM keys seen for a domain, or None."""
+        with self._lock:
+            if domain in self._cache:
+                self._cache.move_to_end(domain)
+                return self._cache[domain]
+
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(
+                    self.url, params={"domain": domain}, timeout=self.timeout
+                )
+            except requests.exceptions.RequestException:
+                response = None
+
+            if response is not None and response.status_code == 200:
+                keys = response.json()
+                break
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                # Client errors won't change on a retry.
+                keys = None
+                break
+            if attempt == self.retries:
+                return None
+            time.sleep(self.retry_delay(response, attempt))
+
+        with self._lock:
+            self._cache[domain] = keys
+            if len(self._cache) > RESPONSE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return keys
+
+    def retry_delay(self, response, attempt):
+        """Returns the seconds to wait before a retry, honoring a Retry-After header in seconds."""
+        retry_after = (
+            response.headers.get("Retry-After") if response is not None else None
+        )
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2**attempt
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_api_rate = DEFAULT_API_RATE
+_settings = {"use_api": True, "selectors": [], "max_selectors": DEFAULT_MAX_SELECTORS}
+_probe_pool = None
+_probe_pool_lock = threading.Lock()
+
+
+def set_api_rate(rate):
+    """Sets the maximum number of DKIM API requests per second."""
+    global _api_rate
+    _api_rate = rate
+    with _clients_lock:
+        _clients.clear()
+
+
+def get_client(api_base_url=DEFAULT_API_BASE_URL):
+    """Returns the shared client for an API base URL."""
+    with _clients_lock:
+        client = _clients.get(api_base_url)
+        if client is None:
+            client = _clients[api_base_url] = DKIMClient(api_base_url, _api_rate)
+        return client
+
+
+def configure(use_api=None, selectors=None, max_selectors=None):
+    """Sets where DKIM records come from: the archive API and/or probing selectors over DNS.
+
+    An empty selector list turns probing off; max_selectors of 0 probes every selector.
+    """
+    settings = {
+        "use_api": use_api,
+        "selectors": selectors,
+        "max_selectors": max_selectors,
+    }
+    for key, value in settings.items():
+        if value is not None:
+            _settings[key] = value
+
+
+def read_selectors(file_name):
+    """Returns the selectors listed in a file, one per line."""
+    with open(file_name, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def submit_probe(fn, *args):
+    """Runs a selector probe in its own pool; probes are started from the lookup pool, which they can't share."""
+    global _probe_pool
+    with _probe_pool_lock:
+        if _probe_pool is None:
+            _probe_pool = ThreadPoolExecutor(
+                max_workers=DEFAULT_PROBE_WORKERS, thread_name_prefix="dkim-probe"
+            )
+    return _probe_pool.submit(contextvars.copy_context().run, fn, *args)
 
 
 class DKIM:
     def __init__(self, domain, dns_server=None, api_base_url=None):
         self.domain = domain
         self.dns_server = dns_server
-        self.api_base_url = "https://archive.prove.email/api"
-        self.dkim_record = self.get_dkim_record()
+        self.api_base_url = api_base_url or DEFAULT_API_BASE_URL
+        with time_stage("dkim"):
+            self.dkim_record = self.get_dkim_record()
 
     def get_dkim_record(self):
-        """Returns the DKIM records for a given domain using the API."""
+        """Returns the DKIM records for a given domain using the API and/or selector probing."""
+        records = []
+        if _settings["use_api"]:
+            try:
+                data = get_client(self.api_base_url).get_keys(self.domain)
+            except (KeyError, ValueError, TypeError):
+                data = None
+            if isinstance(data, list):
+                records.extend(data)
+        if _settings["selectors"]:
+            records.extend(
+                self.probe_selectors(_settings["selectors"], _settings["max_selectors"])
+            )
         try:
-            base_url = self.api_base_url.rstrip('/')
-            url = f"{base_url}/key"
-            params = {"domain": self.domain}
-            headers = {"accept": "application/json"}
-            
-            response = requests.get(url, params=params, headers=headers, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                return self.format_dkim_records(data)
-            elif response.status_code == 400:
-                return None
-            elif response.status_code == 429:
-                return None
-            elif response.status_code == 500:
-                return None
-            else:
-                return None
-        except requests.exceptions.RequestException:
-            return None
+            return self.format_dkim_records(records)
         except (KeyError, ValueError, TypeError):
             return None
 
+    def probe_selectors(self, selectors, max_selectors=DEFAULT_MAX_SELECTORS):
+        """Looks up the selectors concurrently, stopping once max_selectors keys are found.
+
+        Keys are returned in the API's record format, in the order of the selectors.
+        """
+        futures = {
+            submit_probe(self.probe_selector, selector): index
+            for index, selector in enumerate(selectors)
+        }
+        found = []
+        try:
+            for future in as_completed(futures):
+                record = future.result()
+                if record:
+                    found.append((futures[future], record))
+                    if max_selectors and len(found) >= max_selectors:
+                        break
+        finally:
+            for future in futures:
+                future.cancel()
+        return [record for _, record in sorted(found, key=lambda item: item[0])]
+
+    def probe_selector(self, selector):
+        """Returns the DKIM key published at <selector>._domainkey.<domain>, or None."""
+        try:
+            nameservers = [self.dns_server] if self.dns_server else None
+            answer = resolve(f"{selector}._domainkey.{self.domain}", "TXT", nameservers)
+        except dns.exception.DNSException:
+            return None
+        for txt in answer:
+            value = b"".join(txt.strings).decode(errors="replace")
+            # An empty p= is a revoked key (RFC 6376 section 3.6.1).
+            if parse_tags(value).get("p"):
+                return {
+                    "selector": selector,
+                    "domain": self.domain,
+                    "value": value,
+                    # timezone.utc rather than datetime.UTC, which needs Python 3.11.
+                    "lastSeenAt": datetime.now(timezone.utc).isoformat(),  # noqa: UP017
+                }
+        return None
+
     def format_dkim_records(self, api_response):
         """Formats the API response into a readable string format."""
         combined_txt_records = ""
@@ -51,14 +299,15 @@ class DKIM:
             selector = record.get("selector", "unknown")
             domain = record.get("domain", self.domain)
             value = record.get("value", "")
-            last_seen = record.get("lastSeenAt", "")
+            # The API may send a null lastSeenAt, which must still compare with dates.
+            last_seen = record.get("lastSeenAt") or ""
             
             key = f"{selector}._domainkey.{domain}"
             
             if key not in records_by_key:
                 records_by_key[key] = record
             else:
-                existing_last_seen = records_by_key[key].get("lastSeenAt", "")
+                existing_last_seen = records_by_key[key].get("lastSeenAt") or ""
                 if last_seen > existing_last_seen:
                     records_by_key[key] = record
         
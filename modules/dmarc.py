@@ -1,14 +1,38 @@
 # modules/dmarc.py
 
-import dns.resolver
-import tldextract
+from .resolver import resolve, resolve_async, time_stage
+from .syntax import parse_tags
+from .tld import get_registered_domain
 
 
 class DMARC:
     def __init__(self, domain, dns_server=None):
         self.domain = domain
         self.dns_server = dns_server
-        self.dmarc_record = self.get_dmarc_record()
+        with time_stage("dmarc"):
+            self.load(self.get_dmarc_record())
+
+    @classmethod
+    def from_record(cls, domain, dmarc_record, dns_server=None):
+        """Builds a DMARC object from an already fetched record."""
+        dmarc = cls.__new__(cls)
+        dmarc.domain = domain
+        dmarc.dns_server = dns_server
+        dmarc.load(dmarc_record)
+        return dmarc
+
+    @classmethod
+    async def create_async(cls, domain, dns_server=None):
+        """Async counterpart of DMARC(domain, dns_server)."""
+        dmarc = cls.from_record(domain, None, dns_server)
+        with time_stage("dmarc"):
+            dmarc.load(await dmarc.get_dmarc_record_async())
+        return dmarc
+
+    def load(self, dmarc_record):
+        """Sets the DMARC record and the tags parsed from it."""
+        self.dmarc_record = dmarc_record
+        self.tags = parse_tags(dmarc_record) if dmarc_record else {}
         self.policy = None
         self.pct = None
         self.aspf = None
@@ -24,23 +48,39 @@ class DMARC:
             self.fo = self.get_dmarc_forensic_reports()
             self.rua = self.get_dmarc_aggregate_reports()
 
+    def get_dmarc_domain(self):
+        """Returns the domain whose DMARC record applies, which is the registered domain for subdomains."""
+        subdomain = get_registered_domain(self.domain)
+        if subdomain != self.domain:
+            return subdomain
+        return self.domain
+
     def get_dmarc_record(self):
         """Returns the DMARC record for the domain."""
-        subdomain = tldextract.extract(self.domain).registered_domain
-        if subdomain != self.domain:
-            return self.get_dmarc_record_for_domain(subdomain)
+        return self.get_dmarc_record_for_domain(self.get_dmarc_domain())
 
-        return self.get_dmarc_record_for_domain(self.domain)
+    async def get_dmarc_record_async(self):
+        """Async counterpart of get_dmarc_record."""
+        try:
+            nameservers = [self.dns_server] if self.dns_server else None
+            dmarc = await resolve_async(
+                f"_dmarc.{self.get_dmarc_domain()}", "TXT", nameservers
+            )
+        except Exception:
+            return None
+        return self.dmarc_record_from_answer(dmarc)
 
     def get_dmarc_record_for_domain(self, domain):
         try:
-            resolver = dns.resolver.Resolver()
-            if self.dns_server:
-                resolver.nameservers = [self.dns_server]
-            dmarc = resolver.resolve(f"_dmarc.{domain}", "TXT")
+            nameservers = [self.dns_server] if self.dns_server else None
+            dmarc = resolve(f"_dmarc.{domain}", "TXT", nameservers)
         except Exception:
             return None
+        return self.dmarc_record_from_answer(dmarc)
 
+    @staticmethod
+    def dmarc_record_from_answer(dmarc):
+        """Returns the DMARC record among the TXT records of an answer, or None."""
         for dns_data in dmarc:
             if "DMARC1" in str(dns_data):
                 return str(dns_data).replace('"', "")
@@ -48,39 +88,29 @@ class DMARC:
 
     def get_dmarc_policy(self):
         """Returns the policy value from a DMARC record."""
-        if "p=" in str(self.dmarc_record):
-            return str(self.dmarc_record).split("p=")[1].split(";")[0]
-        return None
+        return self.tags.get("p")
 
     def get_dmarc_pct(self):
         """Returns the pct value from a DMARC record."""
-        if "pct=" in str(self.dmarc_record):
-            return str(self.dmarc_record).split("pct=")[1].split(";")[0]
-        return None
+        return self.tags.get("pct")
 
     def get_dmarc_aspf(self):
         """Returns the aspf value from a DMARC record"""
-        if "aspf=" in str(self.dmarc_record):
-            return str(self.dmarc_record).split("aspf=")[1].split(";")[0]
-        return None
+        return self.tags.get("aspf")
 
     def get_dmarc_subdomain_policy(self):
         """Returns the policy to apply for subdomains from a DMARC record."""
-        if "sp=" in str(self.dmarc_record):
-            return str(self.dmarc_record).split("sp=")[1].split(";")[0]
-        return None
+        return self.tags.get("sp")
 
     def get_dmarc_forensic_reports(self):
         """Returns the email addresses to which forensic reports should be sent."""
-        if "ruf=" in str(self.dmarc_record) and "fo=1" in str(self.dmarc_record):
-            return str(self.dmarc_record).split("ruf=")[1].split(";")[0]
+        if "1" in self.tags.get("fo", "").split(":"):
+            return self.tags.get("ruf")
         return None
 
     def get_dmarc_aggregate_reports(self):
         """Returns the email addresses to which aggregate reports should be sent."""
-        if "rua=" in str(self.dmarc_record):
-            return str(self.dmarc_record).split("rua=")[1].split(";")[0]
-        return None
+        return self.tags.get("rua")
 
     def __str__(self):
         return (
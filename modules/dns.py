@@ -1,14 +1,33 @@
 # modules/dns.py
 
-import dns.resolver
-import socket
-from .spf import SPF
-from .dmarc import DMARC
+import asyncio
+
+from . import authoritative
 from .bimi import BIMI
+from .dmarc import DMARC
+from .resolver import (
+    nameserver_health,
+    resolve,
+    resolve_async,
+    select_resolver,
+    submit,
+    time_stage,
+)
+from .spf import SPF
+
+
+def prefetch_organization(organization):
+    """Resolves the records shared by the subdomains of an organization, so that their lookups hit the cache."""
+    DMARC(organization, select_resolver())
+
+
+async def prefetch_organization_async(organization):
+    """Async counterpart of prefetch_organization."""
+    await DMARC.create_async(organization, select_resolver())
 
 
 class DNS:
-    def __init__(self, domain):
+    def __init__(self, domain, lookup=True):
         self.domain = domain
         self.soa_record = None
         self.dns_server = None
@@ -16,51 +35,108 @@ class DNS:
         self.dmarc_record = None
         self.bimi_record = None
 
-        self.get_soa_record()
-        self.get_dns_server()
+        if lookup:
+            with time_stage("soa"):
+                self.get_soa_record()
+            with time_stage("dns_server"):
+                self.get_dns_server()
+
+    @classmethod
+    async def create_async(cls, domain):
+        """Async counterpart of DNS(domain), built on dns.asyncresolver."""
+        dns_info = cls(domain, lookup=False)
+        with time_stage("soa"):
+            await dns_info.get_soa_record_async()
+        with time_stage("dns_server"):
+            await dns_info.get_dns_server_async()
+        return dns_info
 
     def get_soa_record(self):
-        """Sets the SOA record and DNS server of a given domain."""
-        resolver = dns.resolver.Resolver()
-        resolver.nameservers = ["1.1.1.1"]
+        """Sets the SOA record and DNS server of a given domain.
+
+        In authoritative mode, the healthiest server of the domain's zone is used instead; lookups
+        sent to it fall back to the zone's other servers in parallel.
+        """
+        if authoritative.is_enabled():
+            zone_servers = authoritative.get_zone_servers(self.domain)
+            if zone_servers:
+                self.set_zone_server(zone_servers)
+                return
         try:
-            query = resolver.resolve(self.domain, "SOA")
+            query = resolve(self.domain, "SOA", ["1.1.1.1"])
+            dns_server = str(query[0].mname)
         except Exception:
             return
-        if query:
-            for data in query:
-                dns_server = str(data.mname)
-            try:
-                self.soa_record = socket.gethostbyname(dns_server)
-                self.dns_server = self.soa_record
-            except Exception:
-                self.soa_record = None
+        try:
+            address = resolve(dns_server, "A")
+            self.soa_record = str(address[0])
+            self.dns_server = self.soa_record
+        except Exception:
+            self.soa_record = None
 
-    def get_dns_server(self):
-        """Finds the DNS server that serves the domain and retrieves associated SPF, DMARC, and BIMI records."""
-        if self.soa_record:
-            self.spf_record = SPF(self.domain, self.soa_record)
-            self.dmarc_record = DMARC(self.domain, self.soa_record)
-            self.bimi_record = BIMI(self.domain, self.soa_record)
-            if self.spf_record.spf_record and self.dmarc_record.dmarc_record:
+    async def get_soa_record_async(self):
+        """Async counterpart of get_soa_record."""
+        if authoritative.is_enabled():
+            zone_servers = await authoritative.get_zone_servers_async(self.domain)
+            if zone_servers:
+                self.set_zone_server(zone_servers)
                 return
+        try:
+            query = await resolve_async(self.domain, "SOA", ["1.1.1.1"])
+            dns_server = str(query[0].mname)
+        except Exception:
+            return
+        try:
+            address = await resolve_async(dns_server, "A")
+            self.soa_record = str(address[0])
+            self.dns_server = self.soa_record
+        except Exception:
+            self.soa_record = None
 
-        for ip_address in ["1.1.1.1", "8.8.8.8", "9.9.9.9"]:
-            self.spf_record = SPF(self.domain, ip_address)
-            self.dmarc_record = DMARC(self.domain, ip_address)
-            self.bimi_record = BIMI(self.domain, ip_address)
-            if self.spf_record.spf_record and self.dmarc_record.dmarc_record:
-                self.dns_server = ip_address
-                return
+    def set_zone_server(self, zone_servers):
+        self.soa_record = nameserver_health.rank(zone_servers)[0]
+        self.dns_server = self.soa_record
+
+    def get_dns_server(self):
+        """Finds the DNS server that serves the domain and keeps the SPF, DMARC, and BIMI records retrieved from it.
+
+        The SOA server is used if it serves both SPF and DMARC. Otherwise the records come from the
+        healthiest public resolver, which lookups fail over from only when it fails.
+        """
+        if self.soa_record and self.get_records(self.soa_record):
+            return
+        self.dns_server = select_resolver()
+        self.get_records(self.dns_server)
 
-        self.dns_server = "1.1.1.1"
+    async def get_dns_server_async(self):
+        """Async counterpart of get_dns_server."""
+        if self.soa_record and await self.get_records_async(self.soa_record):
+            return
+        self.dns_server = select_resolver()
+        await self.get_records_async(self.dns_server)
+
+    def get_records(self, dns_server):
+        """Retrieves the SPF, DMARC, and BIMI records from a DNS server concurrently. Returns True if both SPF and DMARC were found."""
+        spf = submit(SPF, self.domain, dns_server)
+        dmarc = submit(DMARC, self.domain, dns_server)
+        self.bimi_record = BIMI(self.domain, dns_server)
+        self.spf_record = spf.result()
+        self.dmarc_record = dmarc.result()
+        return bool(self.spf_record.spf_record and self.dmarc_record.dmarc_record)
+
+    async def get_records_async(self, dns_server):
+        """Async counterpart of get_records. The three records are fetched concurrently."""
+        self.spf_record, self.dmarc_record, self.bimi_record = await asyncio.gather(
+            SPF.create_async(self.domain, dns_server),
+            DMARC.create_async(self.domain, dns_server),
+            BIMI.create_async(self.domain, dns_server),
+        )
+        return bool(self.spf_record.spf_record and self.dmarc_record.dmarc_record)
 
     def get_txt_record(self, record_type):
         """Returns the TXT record of a given type for the domain."""
-        resolver = dns.resolver.Resolver()
-        resolver.nameservers = [self.dns_server]
         try:
-            query = resolver.query(self.domain, record_type)
+            query = resolve(self.domain, record_type, [self.dns_server])
             return str(query[0])
         except Exception:
             return None
@@ -0,0 +1,76 @@
+# modules/metrics.py
+
+import json
+import threading
+from collections import Counter
+
+# Upper bounds, in seconds, of the wall time histogram buckets.
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")]
+STAGES = ["total", "soa", "dns_server", "spf", "dmarc", "bimi", "dkim"]
+
+
+class MetricsRecorder:
+    """Collects the per-domain query stats of a run into histograms and, optionally, a JSON Lines file.
+
+    Stages can overlap (SPF and DMARC run concurrently within the nameserver selection), so their
+    times don't add up to the total. The file is open while the recorder is used as a context manager.
+    """
+
+    def __init__(self, file_name=None):
+        self.file_name = file_name
+        self.file = None
+        self.domains = 0
+        self.queries = 0
+        self.cache_hits = 0
+        self.timeouts = 0
+        self.nameservers = Counter()
+        self.histograms = {stage: [0] * len(BUCKETS) for stage in STAGES}
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self._lock = threading.Lock()
+
+    def record(self, domain, query_stats):
+        """Adds the stats of a domain to the run."""
+        entry = {
+            "DOMAIN": domain,
+            "DNS_QUERIES": query_stats.queries,
+            "CACHE_HITS": query_stats.cache_hits,
+            "TIMEOUTS": query_stats.timeouts,
+            "NAMESERVERS": dict(query_stats.nameservers),
+            "STAGES": {
+                stage: round(seconds, 6)
+                for stage, seconds in query_stats.stages.items()
+            },
+        }
+        with self._lock:
+            if self.file:
+                self.file.write(json.dumps(entry) + "\n")
+            self.domains += 1
+            self.queries += query_stats.queries
+            self.cache_hits += query_stats.cache_hits
+            self.timeouts += query_stats.timeouts
+            self.nameservers.update(query_stats.nameservers)
+            for stage, seconds in query_stats.stages.items():
+                histogram = self.histograms.setdefault(stage, [0] * len(BUCKETS))
+                histogram[bucket_index(seconds)] += 1
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def __enter__(self):
+        if self.file_name:
+            self.file = open(self.file_name, "w")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def bucket_index(seconds):
+    """Returns the index of the histogram bucket a duration falls in."""
+    for index, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return index
+    return len(BUCKETS) - 1
@@ -1,16 +1,61 @@
 # modules/report.py
 
-import os
-import pandas as pd
+import csv
 import json
-from colorama import init, Fore, Style
+import os
+import sys
+import threading
+from queue import Queue
+
+from colorama import Fore, Style, init
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+from .metrics import BUCKETS
 
 # Initialize colorama
 init()
 
+# Columns and types of the result dict built by spoofy.build_result, in order. Columnar
+# writers use it as their fixed schema.
+RESULT_SCHEMA = {
+    "DOMAIN": str,
+    "DOMAIN_TYPE": str,
+    "DNS_SERVER": str,
+    "SPF": str,
+    "SPF_MULTIPLE_ALLS": str,
+    "SPF_NUM_DNS_QUERIES": int,
+    "SPF_TOO_MANY_DNS_QUERIES": bool,
+    "DMARC": str,
+    "DMARC_POLICY": str,
+    "DMARC_PCT": str,
+    "DMARC_ASPF": str,
+    "DMARC_SP": str,
+    "DMARC_FORENSIC_REPORT": str,
+    "DMARC_AGGREGATE_REPORT": str,
+    "DKIM": str,
+    "BIMI_RECORD": str,
+    "BIMI_VERSION": str,
+    "BIMI_LOCATION": str,
+    "BIMI_AUTHORITY": str,
+    "SPOOFING_POSSIBLE": bool,
+    "SPOOFING_TYPE": str,
+    "DNS_QUERIES": int,
+    "DNS_MIN_TTL": int,
+    "DNS_FAILURES": int,
+}
+PARQUET_BATCH_SIZE = 10000
+
 
 def output_message(symbol, message, level="info"):
     """Generic function to print messages with different colors and symbols based on the level."""
+    print(format_message(symbol, message, level))
+
+
+def format_message(symbol, message, level="info", color=True):
+    """Returns a message line with the color and symbol of its level, or plain if color is False."""
+    if not color:
+        return f"{'!!! ' if level == 'error' else ''}{symbol} {message}"
     colors = {
         "good": Fore.GREEN + Style.BRIGHT,
         "warning": Fore.YELLOW + Style.BRIGHT,
@@ -20,66 +65,327 @@ def output_message(symbol, message, level="info"):
         "info": Fore.WHITE + Style.BRIGHT,
     }
     color = colors.get(level, Fore.WHITE + Style.BRIGHT)
-    print(color + f"{symbol} {message}" + Style.RESET_ALL)
+    return color + f"{symbol} {message}" + Style.RESET_ALL
 
 
 def write_to_excel(data, file_name="output.xlsx"):
-    """Writes a DataFrame of data to an Excel file, appending if the file exists."""
-    if os.path.exists(file_name) and os.path.getsize(file_name) > 0:
-        existing_df = pd.read_excel(file_name)
-        new_df = pd.DataFrame(data)
-        combined_df = pd.concat([existing_df, new_df])
-        combined_df.to_excel(file_name, index=False)
-    else:
-        pd.DataFrame(data).to_excel(file_name, index=False)
+    """Writes a list of results to an Excel file, appending if the file exists."""
+    writer = ExcelWriter(file_name)
+    for result in data:
+        writer.write(result)
+    writer.close()
+
+
+class StdoutWriter:
+    """Prints each result as soon as it is written.
+
+    Blocks are rendered by the calling thread and printed by a dedicated output thread, which
+    writes everything queued so far at once. ANSI colors are left out when stdout isn't a terminal,
+    unless color is set.
+    """
+
+    def __init__(self, stream=None, color=None):
+        # colorama strips ANSI codes from sys.stdout when it isn't a terminal, so forced colors go
+        # to the unwrapped stream.
+        self.stream = stream or (sys.__stdout__ if color else sys.stdout)
+        self.color = self.stream.isatty() if color is None else color
+        self.blocks = Queue()
+        self.thread = threading.Thread(target=self.output, daemon=True)
+        self.thread.start()
+
+    def write(self, result):
+        self.blocks.put(render_result(result, self.color))
+
+    def output(self):
+        while True:
+            blocks = [self.blocks.get()]
+            while not self.blocks.empty():
+                blocks.append(self.blocks.get())
+            done = blocks[-1] is None
+            self.stream.write("".join(block for block in blocks if block is not None))
+            self.stream.flush()
+            if done:
+                return
+
+    def close(self):
+        self.blocks.put(None)
+        self.thread.join()
+
+
+class JSONWriter:
+    """Streams results to stdout as one JSON array, one element per line."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def write(self, result):
+        with self._lock:
+            separator = "[\n" if self.count == 0 else ",\n"
+            self.stream.write(separator + json.dumps(result, default=str))
+            self.stream.flush()
+            self.count += 1
+
+    def close(self):
+        self.stream.write("\n]\n" if self.count else "[]\n")
+        self.stream.flush()
+
+
+class JSONLinesWriter:
+    """Streams results to stdout as JSON Lines, one object per domain."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def write(self, result):
+        with self._lock:
+            self.stream.write(json.dumps(result, default=str) + "\n")
+            self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class ExcelWriter:
+    """Streams results to an Excel file as they are written, appending if the file exists.
+
+    Rows go through an openpyxl write-only workbook, so memory stays bounded. xlsx files can't be
+    extended in place: on append, the existing rows are streamed into the new file first, without
+    being loaded all at once. The file is replaced when the writer is closed.
+    """
+
+    def __init__(self, file_name="output.xlsx"):
+        self.file_name = file_name
+        self.temp_file_name = f"{file_name}.tmp"
+        self.workbook = None
+        self.sheet = None
+        self.columns = None
+        self._lock = threading.Lock()
+
+    def open(self, result):
+        self.workbook = Workbook(write_only=True)
+        sheet = self.workbook.create_sheet("Sheet1")
+        if os.path.exists(self.file_name) and os.path.getsize(self.file_name) > 0:
+            existing = load_workbook(self.file_name, read_only=True)
+            rows = existing.worksheets[0].iter_rows(values_only=True)
+            self.columns = [column for column in next(rows, ()) if column is not None]
+            self.columns += [key for key in result if key not in self.columns]
+            sheet.append(self.columns)
+            for row in rows:
+                sheet.append(row)
+            existing.close()
+        else:
+            self.columns = list(result)
+            sheet.append(self.columns)
+        self.sheet = sheet
+
+    def write(self, result):
+        with self._lock:
+            if self.workbook is None:
+                self.open(result)
+            self.sheet.append([_excel_value(result.get(key)) for key in self.columns])
 
-def output_json(results):
-    output = []
-    for result in results:
-        output.append(result)
-    print(json.dumps(output))
+    def close(self):
+        if self.workbook is None:
+            return
+        self.workbook.save(self.temp_file_name)
+        os.replace(self.temp_file_name, self.file_name)
+        self.workbook = None
+        print(f"Results written to {self.file_name}")
 
 
+def _excel_value(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return ILLEGAL_CHARACTERS_RE.sub("", str(value))
+
+
+class CSVWriter:
+    """Streams results to stdout as CSV, with the columns of RESULT_SCHEMA."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+        self.writer = csv.DictWriter(
+            self.stream, fieldnames=list(RESULT_SCHEMA), extrasaction="ignore"
+        )
+        self.writer.writeheader()
+
+    def write(self, result):
+        with self._lock:
+            self.writer.writerow(result)
+            self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """Streams results to a Parquet file in record batches, with RESULT_SCHEMA as its schema.
+
+    Requires pyarrow, which is imported when the writer is created.
+    """
+
+    def __init__(self, file_name="output.parquet", batch_size=PARQUET_BATCH_SIZE):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError(
+                "-o parquet requires pyarrow (pip install pyarrow)"
+            ) from error
+        types = {str: pa.string(), int: pa.int64(), bool: pa.bool_()}
+        self.pa = pa
+        self.schema = pa.schema(
+            [(column, types[kind]) for column, kind in RESULT_SCHEMA.items()]
+        )
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.writer = pq.ParquetWriter(file_name, self.schema)
+        self.columns = {column: [] for column in RESULT_SCHEMA}
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def write(self, result):
+        with self._lock:
+            for column, kind in RESULT_SCHEMA.items():
+                value = result.get(column)
+                self.columns[column].append(None if value is None else kind(value))
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.writer.write_batch(
+                self.pa.record_batch(list(self.columns.values()), schema=self.schema)
+            )
+            for values in self.columns.values():
+                values.clear()
+            self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        print(f"Results written to {self.file_name}")
+
+
+def open_writer(output, color=None):
+    """Returns the result writer for an output format. Writers can be shared by several threads.
+
+    color only applies to stdout: None colors the output when stdout is a terminal.
+    """
+    if output == "stdout":
+        return StdoutWriter(color=color)
+    writers = {
+        "json": JSONWriter,
+        "jsonl": JSONLinesWriter,
+        "csv": CSVWriter,
+        "xls": ExcelWriter,
+        "parquet": ParquetWriter,
+    }
+    return writers[output]()
+
+
+def print_summary(query_stats):
+    """Prints the DNS lookup and cache totals of a run to stderr, keeping stdout clean for results."""
+    lookups = query_stats.lookups
+    hit_rate = query_stats.cache_hits / lookups * 100 if lookups else 0
+    print(
+        f"[*] DNS lookups: {lookups}, cache hits: {query_stats.cache_hits}, "
+        f"cache misses: {lookups - query_stats.cache_hits} ({hit_rate:.1f}% hit rate), "
+        f"coalesced in flight: {query_stats.coalesced}, queries: {query_stats.queries}",
+        file=sys.stderr,
+    )
+    if query_stats.failures:
+        print(
+            f"[?] DNS lookups failed on every server: {query_stats.failures}",
+            file=sys.stderr,
+        )
+
+
+def print_metrics(metrics):
+    """Prints the per-stage wall time histograms, timeouts and answering nameservers of a run to stderr."""
+    labels = [
+        f"<={bound * 1000:g}ms" if bound < 1 else f"<={bound:g}s"
+        for bound in BUCKETS[:-1]
+    ] + [f">{BUCKETS[-2]:g}s"]
+    lines = [
+        f"[*] Wall time per stage over {metrics.domains} domains (domains per bucket):",
+        f"{'stage':<12}{'mean':>9}" + "".join(f"{label:>9}" for label in labels),
+    ]
+    for stage, histogram in metrics.histograms.items():
+        count = sum(histogram)
+        if not count:
+            continue
+        mean = metrics.seconds[stage] / count * 1000
+        lines.append(
+            f"{stage:<12}{mean:>7.1f}ms" + "".join(f"{n:>9}" for n in histogram)
+        )
+    lines.append(
+        f"[*] DNS queries: {metrics.queries}, cache hits: {metrics.cache_hits}, "
+        f"timeouts: {metrics.timeouts}"
+    )
+    answered = ", ".join(
+        f"{nameserver}: {count}"
+        for nameserver, count in metrics.nameservers.most_common()
+    )
+    lines.append(f"[*] Queries answered by nameserver: {answered or 'none'}")
+    print("\n".join(lines), file=sys.stderr)
 
 
 def printer(**kwargs):
     """Utility function to print the results of DMARC, SPF, and BIMI checks in the original format."""
-    domain = kwargs.get("DOMAIN")
-    subdomain = kwargs.get("DOMAIN_TYPE") == "subdomain"
-    dns_server = kwargs.get("DNS_SERVER")
-    spf_record = kwargs.get("SPF")
-    spf_all = kwargs.get("SPF_MULTIPLE_ALLS")
-    spf_dns_query_count = kwargs.get("SPF_NUM_DNS_QUERIES")
-    dmarc_record = kwargs.get("DMARC")
-    p = kwargs.get("DMARC_POLICY")
-    pct = kwargs.get("DMARC_PCT")
-    aspf = kwargs.get("DMARC_ASPF")
-    sp = kwargs.get("DMARC_SP")
-    fo = kwargs.get("DMARC_FORENSIC_REPORT")
-    rua = kwargs.get("DMARC_AGGREGATE_REPORT")
-    dkim_record = kwargs.get("DKIM")
-    bimi_record = kwargs.get("BIMI_RECORD")
-    vbimi = kwargs.get("BIMI_VERSION")
-    location = kwargs.get("BIMI_LOCATION")
-    authority = kwargs.get("BIMI_AUTHORITY")
-    spoofable = kwargs.get("SPOOFING_POSSIBLE")
-    spoofing_type = kwargs.get("SPOOFING_TYPE")
-
-    output_message("[*]", f"Domain: {domain}", "indifferent")
-    output_message("[*]", f"Is subdomain: {subdomain}", "indifferent")
-    output_message("[*]", f"DNS Server: {dns_server}", "indifferent")
+    sys.stdout.write(render_result(kwargs, sys.stdout.isatty()))
+    sys.stdout.flush()
+
+
+def render_result(result, color=True):
+    """Renders the printer block of a result into a single string."""
+    lines = []
+
+    def add_message(symbol, message, level="info"):
+        lines.append(format_message(symbol, message, level, color))
+
+    domain = result.get("DOMAIN")
+    subdomain = result.get("DOMAIN_TYPE") == "subdomain"
+    dns_server = result.get("DNS_SERVER")
+    spf_record = result.get("SPF")
+    spf_all = result.get("SPF_MULTIPLE_ALLS")
+    spf_dns_query_count = result.get("SPF_NUM_DNS_QUERIES")
+    dmarc_record = result.get("DMARC")
+    p = result.get("DMARC_POLICY")
+    pct = result.get("DMARC_PCT")
+    aspf = result.get("DMARC_ASPF")
+    sp = result.get("DMARC_SP")
+    fo = result.get("DMARC_FORENSIC_REPORT")
+    rua = result.get("DMARC_AGGREGATE_REPORT")
+    dkim_record = result.get("DKIM")
+    bimi_record = result.get("BIMI_RECORD")
+    vbimi = result.get("BIMI_VERSION")
+    location = result.get("BIMI_LOCATION")
+    authority = result.get("BIMI_AUTHORITY")
+    spoofable = result.get("SPOOFING_POSSIBLE")
+    spoofing_type = result.get("SPOOFING_TYPE")
+    dns_failures = result.get("DNS_FAILURES")
+
+    add_message("[*]", f"Domain: {domain}", "indifferent")
+    add_message("[*]", f"Is subdomain: {subdomain}", "indifferent")
+    add_message("[*]", f"DNS Server: {dns_server}", "indifferent")
 
     if spf_record:
-        output_message("[*]", f"SPF record: {spf_record}", "info")
+        add_message("[*]", f"SPF record: {spf_record}", "info")
         if spf_all is None:
-            output_message("[*]", "SPF does not contain an `All` item.", "info")
+            add_message("[*]", "SPF does not contain an `All` item.", "info")
         elif spf_all == "2many":
-            output_message(
+            add_message(
                 "[?]", "SPF record contains multiple `All` items.", "warning"
             )
         else:
-            output_message("[*]", f"SPF all record: {spf_all}", "info")
-        output_message(
+            add_message("[*]", f"SPF all record: {spf_all}", "info")
+        add_message(
             "[*]",
             f"SPF DNS query count: {spf_dns_query_count}"
             if spf_dns_query_count <= 10
@@ -87,36 +393,36 @@ def printer(**kwargs):
             "info",
         )
     else:
-        output_message("[?]", "No SPF record found.", "warning")
+        add_message("[?]", "No SPF record found.", "warning")
 
     if dmarc_record:
-        output_message("[*]", f"DMARC record: {dmarc_record}", "info")
-        output_message(
+        add_message("[*]", f"DMARC record: {dmarc_record}", "info")
+        add_message(
             "[*]", f"Found DMARC policy: {p}" if p else "No DMARC policy found.", "info"
         )
-        output_message(
+        add_message(
             "[*]", f"Found DMARC pct: {pct}" if pct else "No DMARC pct found.", "info"
         )
-        output_message(
+        add_message(
             "[*]",
             f"Found DMARC aspf: {aspf}" if aspf else "No DMARC aspf found.",
             "info",
         )
-        output_message(
+        add_message(
             "[*]",
             f"Found DMARC subdomain policy: {sp}"
             if sp
             else "No DMARC subdomain policy found.",
             "info",
         )
-        output_message(
+        add_message(
             "[*]",
             f"Forensics reports will be sent: {fo}"
             if fo
             else "No DMARC forensics report location found.",
             "indifferent",
         )
-        output_message(
+        add_message(
             "[*]",
             f"Aggregate reports will be sent to: {rua}"
             if rua
@@ -124,22 +430,30 @@ def printer(**kwargs):
             "indifferent",
         )
     else:
-        output_message("[?]", "No DMARC record found.", "warning")
+        add_message("[?]", "No DMARC record found.", "warning")
 
     if dkim_record:
-        output_message("[*]", f"DKIM selectors: \r\n{dkim_record}", "info")
+        add_message("[*]", f"DKIM selectors: \r\n{dkim_record}", "info")
     else:
-        output_message("[?]", f"No known DKIM selectors enumerated on {domain}.", "warning")
+        add_message("[?]", f"No known DKIM selectors enumerated on {domain}.", "warning")
 
     if bimi_record:
-        output_message("[*]", f"BIMI record: {bimi_record}", "info")
-        output_message("[*]", f"BIMI version: {vbimi}", "info")
-        output_message("[*]", f"BIMI location: {location}", "info")
-        output_message("[*]", f"BIMI authority: {authority}", "info")
+        add_message("[*]", f"BIMI record: {bimi_record}", "info")
+        add_message("[*]", f"BIMI version: {vbimi}", "info")
+        add_message("[*]", f"BIMI location: {location}", "info")
+        add_message("[*]", f"BIMI authority: {authority}", "info")
+
+    if dns_failures:
+        add_message(
+            "[?]",
+            f"{dns_failures} DNS lookups failed on every server; their records are unknown.",
+            "warning",
+        )
 
     if spoofing_type:
         level = "good" if spoofable else "bad"
         symbol = "[+]" if level == "good" else "[-]"
-        output_message(symbol, spoofing_type, level)
+        add_message(symbol, spoofing_type, level)
 
-    print()  # Padding
+    lines.append("")  # Padding
+    return "\n".join(lines) + "\n"
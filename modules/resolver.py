@@ -0,0 +1,986 @@
+# modules/resolver.py
+
+import asyncio
+import contextvars
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import dns.asyncresolver
+import dns.exception
+import dns.flags
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_LOOKUP_WORKERS = 16
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_LIFETIME = 5.0
+DEFAULT_RETRIES = 0
+PUBLIC_NAMESERVERS = ["1.1.1.1", "8.8.8.8", "9.9.9.9"]
+
+# Seconds an authoritative server gets to respond before the query is also sent to the next one.
+HEDGE_DELAY = 0.25
+HEDGE_WORKERS = 64
+
+# Queries/sec each server gets at most (0 for no cap). A server whose error rate reaches
+# BACKOFF_ERROR_RATE has its rate halved, at most once per BACKOFF_INTERVAL seconds and down to
+# MIN_SERVER_RATE, and it then recovers by RATE_RECOVERY of its rate every second.
+DEFAULT_SERVER_RATE = 0
+MIN_SERVER_RATE = 5.0
+BACKOFF_ERROR_RATE = 0.25
+BACKOFF_INTERVAL = 1.0
+RATE_RECOVERY = 0.1
+
+# Weight of the latest sample in the moving averages of nameserver health, and the half-life
+# of an error, in seconds, so that a server that failed gets traffic again once it recovers.
+HEALTH_ALPHA = 0.2
+HEALTH_ERROR_HALF_LIFE = 30.0
+
+# Resolvers kept per thread, per nameserver set; SOA servers differ per domain, so the pool is bounded.
+RESOLVER_POOL_SIZE = 256
+
+_query_stats = contextvars.ContextVar("query_stats", default=None)
+# The answer served from the cache by the current lookup, if any, to tell cached answers from fresh ones.
+_cached_answer = contextvars.ContextVar("cached_answer", default=None)
+
+
+class QueryStats:
+    def __init__(self):
+        self.lookups = 0
+        self.cache_hits = 0
+        self.timeouts = 0
+        self.failures = 0
+        # Lookups that shared the answer of an identical lookup in flight.
+        self.coalesced = 0
+        self.min_ttl = None
+        # (name, rdtype) of the lookups that every server failed and no later lookup answered:
+        # their records are unknown, not missing.
+        self.unresolved = set()
+        # Queries answered by each nameserver, and seconds spent in each stage of a domain.
+        self.nameservers = Counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @property
+    def queries(self):
+        """Lookups that had to go out to a DNS server."""
+        return self.lookups - self.cache_hits - self.coalesced
+
+    def record(self, counter):
+        """Increments one of the counters."""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def record_nameserver(self, nameserver):
+        """Counts a query answered by a nameserver."""
+        with self._lock:
+            self.nameservers[nameserver] += 1
+
+    def record_stage(self, stage, seconds):
+        """Adds the time spent in a stage. Stages that run more than once add up."""
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def record_outcome(self, query, resolved):
+        """Marks a (name, rdtype) query as answered (including NXDOMAIN and empty answers) or failed."""
+        with self._lock:
+            if resolved:
+                self.unresolved.discard(query)
+            else:
+                self.unresolved.add(query)
+
+    def is_unresolved(self, qname, rdtype):
+        """Returns True if every server failed the last lookup of a query."""
+        return (qname.rstrip(".").lower(), rdtype) in self.unresolved
+
+    def record_ttl(self, ttl):
+        """Keeps the lowest remaining TTL of the answers seen."""
+        with self._lock:
+            if self.min_ttl is None or ttl < self.min_ttl:
+                self.min_ttl = ttl
+
+    def __str__(self):
+        return (
+            f"DNS Lookups: {self.lookups}\n"
+            f"Cache Hits: {self.cache_hits}\n"
+            f"Coalesced: {self.coalesced}\n"
+            f"DNS Queries: {self.queries}"
+        )
+
+
+# Totals across every domain of the run.
+totals = QueryStats()
+
+
+def _record(counter):
+    totals.record(counter)
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.record(counter)
+
+
+def _record_answer(answer):
+    stats = _query_stats.get()
+    fresh = _cached_answer.get() is None
+    if fresh:
+        totals.record_nameserver(answer.nameserver)
+    if stats is not None:
+        stats.record_ttl(max(0, int(answer.expiration - time.time())))
+        if fresh:
+            stats.record_nameserver(answer.nameserver)
+    return answer
+
+
+def _record_outcome(qname, rdtype, resolved):
+    if not resolved:
+        _record("failures")
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.record_outcome((str(qname).rstrip(".").lower(), rdtype), resolved)
+
+
+class AnswerCache(dns.resolver.LRUCache):
+    """Process-wide answer cache. Entries expire with their TTL and the least recently used are evicted first.
+
+    Entries are keyed by the cache scope of the server that gave them, see ScopedCache.
+    """
+
+    def contains(self, qname, rdtype, nameserver=None):
+        """Returns True if a live answer to a query sent to a server is cached, without counting a hit."""
+        key = (
+            _cache_scope(nameserver),
+            dns.name.from_text(str(qname)),
+            dns.rdatatype.RdataType.make(rdtype),
+            dns.rdataclass.IN,
+        )
+        with self.lock:
+            node = self.data.get(key)
+            return node is not None and node.value.expiration > time.time()
+
+    def get(self, key):
+        answer = super().get(key)
+        if answer is not None:
+            _record("cache_hits")
+            _cached_answer.set(answer)
+        return answer
+
+
+answer_cache = AnswerCache(DEFAULT_CACHE_SIZE)
+
+
+class ScopedCache:
+    """A resolver's view of the shared answer cache.
+
+    Recursive resolvers are interchangeable and share their answers. Any other server, such as a
+    domain's SOA server, has a scope of its own, so that its answers, and above all its empty and
+    negative ones, are never served for a lookup aimed at another server.
+    """
+
+    def __init__(self, nameserver=None):
+        self.nameserver = nameserver
+
+    def get(self, key):
+        return answer_cache.get((_cache_scope(self.nameserver), *key))
+
+    def put(self, key, answer):
+        # A reply without the AA flag from a zone's authoritative server is a referral or a lame
+        # delegation; the lookup fails over, so it must not be read back as an answer.
+        if self.nameserver in _server_zones and not (
+            answer.response.flags & dns.flags.AA
+        ):
+            return
+        answer_cache.put((_cache_scope(self.nameserver), *key), answer)
+
+
+def _cache_scope(nameserver):
+    if (
+        nameserver is None
+        or nameserver in PUBLIC_NAMESERVERS
+        or nameserver in get_public_resolvers()
+        or nameserver in get_system_nameservers()
+        or nameserver in (_policy["nameservers"] or ())
+    ):
+        return None
+    return nameserver
+
+
+def set_cache_size(max_size):
+    """Sets the maximum number of answers kept in the shared cache."""
+    answer_cache.set_max_size(max_size)
+
+
+_lookup_pool = None
+_lookup_workers = DEFAULT_LOOKUP_WORKERS
+_lookup_pool_lock = threading.Lock()
+
+
+def set_lookup_workers(max_workers):
+    """Sets the number of threads used to run the lookups of a domain concurrently."""
+    global _lookup_workers
+    _lookup_workers = max_workers
+
+
+def submit(fn, *args):
+    """Runs fn(*args) in the shared lookup pool, counting its queries against the current domain.
+
+    Functions submitted here must not submit and wait on further work, or the pool can deadlock.
+    """
+    global _lookup_pool
+    with _lookup_pool_lock:
+        if _lookup_pool is None:
+            _lookup_pool = ThreadPoolExecutor(
+                max_workers=_lookup_workers, thread_name_prefix="lookup"
+            )
+    return _lookup_pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+@contextmanager
+def time_stage(stage):
+    """Adds the wall time spent inside the block to a stage of the domain being tracked."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = _query_stats.get()
+        if stats is not None:
+            stats.record_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def track_queries():
+    """Counts every DNS lookup made through this module inside the block."""
+    stats = QueryStats()
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+class NameserverHealth:
+    """Latency and error rate of each nameserver over the run, as exponentially weighted moving averages."""
+
+    def __init__(self, alpha=HEALTH_ALPHA, half_life=HEALTH_ERROR_HALF_LIFE):
+        self.alpha = alpha
+        self.half_life = half_life
+        self.latency = {}
+        self.errors = {}
+        self.updated_at = {}
+        self._lock = threading.Lock()
+
+    def record(self, nameserver, seconds, failed=False):
+        """Adds the outcome of a query sent to a nameserver."""
+        with self._lock:
+            latency = self.latency.get(nameserver, seconds)
+            self.latency[nameserver] = latency + self.alpha * (seconds - latency)
+            errors = self.error_rate(nameserver)
+            self.errors[nameserver] = errors + self.alpha * (failed - errors)
+            self.updated_at[nameserver] = time.monotonic()
+
+    def error_rate(self, nameserver):
+        """Returns the error rate of a nameserver, decayed since its last query."""
+        errors = self.errors.get(nameserver, 0.0)
+        if errors:
+            elapsed = time.monotonic() - self.updated_at[nameserver]
+            errors *= 0.5 ** (elapsed / self.half_life)
+        return errors
+
+    def score(self, nameserver):
+        """Expected cost of a query to a nameserver; lower is better and unmeasured servers come first."""
+        latency = self.latency.get(nameserver, 0.0)
+        return latency / max(1.0 - self.error_rate(nameserver), 0.01)
+
+    def rank(self, nameservers):
+        """Returns the nameservers from healthiest to least healthy, keeping the given order on ties."""
+        with self._lock:
+            return sorted(nameservers, key=self.score)
+
+
+nameserver_health = NameserverHealth()
+
+
+class RateGovernor:
+    """Paces the queries sent to each server, adapting the pace to how the server copes.
+
+    Each server gets at most max_rate queries/sec. When its error rate spikes (throttling shows up
+    as SERVFAIL, REFUSED and timeouts), its rate is halved, starting from the rate it was actually
+    getting if it had no cap, and then raised back gradually while it keeps up. Failures of queries
+    sent before the last backoff don't count again.
+    """
+
+    def __init__(self, max_rate=DEFAULT_SERVER_RATE):
+        self.max_rate = max_rate or float("inf")
+        self.rates = {}
+        self.changed_at = {}
+        self.backoff_at = {}
+        self.next_send = {}
+        # Queries sent in the current one second window, and the rate of the last full window.
+        self.window = {}
+        self.sent_rate = {}
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """True if some server is paced."""
+        return self.max_rate != float("inf") or bool(self.rates)
+
+    def set_max_rate(self, max_rate):
+        with self._lock:
+            self.max_rate = max_rate or float("inf")
+            self.rates.clear()
+            self.next_send.clear()
+
+    def record_sent(self, nameserver):
+        """Counts a query that reached a server."""
+        with self._lock:
+            now = time.monotonic()
+            start, count = self.window.get(nameserver, (now, 0))
+            if now - start >= 1.0:
+                self.sent_rate[nameserver] = count / (now - start)
+                start, count = now, 0
+            self.window[nameserver] = (start, count + 1)
+
+    def reserve(self, nameserver, max_delay=float("inf")):
+        """Reserves the next send slot of a server and returns the seconds to wait for it.
+
+        Returns None, reserving nothing, if the slot is more than max_delay seconds away.
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate = self._recover(nameserver, now)
+            if rate == float("inf"):
+                return 0.0
+            send_at = max(now, self.next_send.get(nameserver, now))
+            if send_at - now > max_delay:
+                return None
+            self.next_send[nameserver] = send_at + 1.0 / rate
+            return send_at - now
+
+    def failed(self, nameserver, seconds):
+        """Backs off from a server whose query just failed after `seconds`, if its error rate is high."""
+        if nameserver_health.error_rate(nameserver) < BACKOFF_ERROR_RATE:
+            return
+        with self._lock:
+            now = time.monotonic()
+            backoff_at = self.backoff_at.get(nameserver, float("-inf"))
+            if now - seconds < backoff_at or now - backoff_at < BACKOFF_INTERVAL:
+                return
+            rate = self.rates.get(nameserver, self.max_rate)
+            if rate == float("inf"):
+                rate = self._sent_rate(nameserver, now)
+            self.rates[nameserver] = max(MIN_SERVER_RATE, rate / 2)
+            self.backoff_at[nameserver] = self.changed_at[nameserver] = now
+
+    def _sent_rate(self, nameserver, now):
+        start, count = self.window.get(nameserver, (now, 0))
+        return max(self.sent_rate.get(nameserver, 0.0), count / max(now - start, 1.0))
+
+    def _recover(self, nameserver, now):
+        rate = self.rates.get(nameserver)
+        if rate is None:
+            return self.max_rate
+        if now - self.backoff_at[nameserver] >= BACKOFF_INTERVAL:
+            rate *= (1.0 + RATE_RECOVERY) ** (now - self.changed_at[nameserver])
+            self.changed_at[nameserver] = now
+            # Back to the cap, or, without one, well above what the server is asked for.
+            if rate >= min(self.max_rate, 2 * self._sent_rate(nameserver, now)):
+                del self.rates[nameserver]
+                self.next_send.pop(nameserver, None)
+                return self.max_rate
+            self.rates[nameserver] = rate
+        return rate
+
+
+rate_governor = RateGovernor()
+
+
+def set_server_rate(max_rate):
+    """Sets the maximum number of queries per second sent to each server, 0 for no cap."""
+    rate_governor.set_max_rate(max_rate)
+
+
+def _is_paced(qname, rdtype, nameserver):
+    # Answers served from the cache don't reach a server, so they aren't paced.
+    return rate_governor.active and not answer_cache.contains(qname, rdtype, nameserver)
+
+
+_policy = {
+    "timeout": DEFAULT_TIMEOUT,
+    "lifetime": DEFAULT_LIFETIME,
+    "retries": DEFAULT_RETRIES,
+    "nameservers": None,
+    "port": 53,
+    "resolvers": None,
+}
+_policy_generation = 0
+_resolvers = threading.local()
+_system_nameservers = None
+
+
+def configure(
+    timeout=None,
+    lifetime=None,
+    retries=None,
+    nameservers=None,
+    port=None,
+    resolvers=None,
+):
+    """Sets the per-server timeout, total lifetime, and number of retries after a timeout, for every lookup.
+
+    If resolvers is given, lookups that would go to a public or system resolver go to those
+    resolvers instead, e.g. to use internal resolvers. If nameservers is given, every lookup is
+    sent to those servers (on the given port) regardless of the servers it asks for, e.g. to run
+    against a local stub server.
+    """
+    global _policy_generation
+    settings = {
+        "timeout": timeout,
+        "lifetime": lifetime,
+        "retries": retries,
+        "nameservers": nameservers,
+        "port": port,
+        "resolvers": resolvers,
+    }
+    for key, value in settings.items():
+        if value is not None:
+            _policy[key] = value
+    _policy_generation += 1
+
+
+def get_system_nameservers():
+    """Returns the nameservers from /etc/resolv.conf, read once per run."""
+    global _system_nameservers
+    if _system_nameservers is None:
+        _system_nameservers = dns.resolver.Resolver().nameservers
+    return _system_nameservers
+
+
+def get_public_resolvers():
+    """Returns the recursive resolvers used in place of the public ones: the configured list, if any."""
+    return _policy["resolvers"] or PUBLIC_NAMESERVERS
+
+
+def select_resolver():
+    """Returns the healthiest public (or configured) resolver."""
+    return nameserver_health.rank(get_public_resolvers())[0]
+
+
+def get_candidates(nameservers=None):
+    """Returns the servers to try for a lookup, in order.
+
+    Recursive resolvers are interchangeable: asking for a public resolver means asking the healthiest
+    public (or configured) resolver, and asking for no server in particular means asking the
+    healthiest system (or configured) resolver. Other servers, such as a domain's SOA server, are
+    tried as given.
+    """
+    if _policy["nameservers"]:
+        return list(_policy["nameservers"])
+    public_resolvers = get_public_resolvers()
+    candidates = []
+    for nameserver in nameservers or [None]:
+        if nameserver is None:
+            group = _policy["resolvers"] or get_system_nameservers()
+        elif nameserver in PUBLIC_NAMESERVERS or nameserver in public_resolvers:
+            group = public_resolvers
+        else:
+            group = [nameserver]
+        for candidate in nameserver_health.rank(group):
+            if candidate not in candidates:
+                candidates.append(candidate)
+    return candidates
+
+
+def _record_success(nameserver, start):
+    if _cached_answer.get() is None:
+        nameserver_health.record(nameserver, time.perf_counter() - start)
+        rate_governor.record_sent(nameserver)
+
+
+def _record_failure(nameserver, start, error):
+    if isinstance(error, dns.exception.Timeout):
+        _record("timeouts")
+    seconds = time.perf_counter() - start
+    nameserver_health.record(nameserver, seconds, failed=True)
+    rate_governor.record_sent(nameserver)
+    rate_governor.failed(nameserver, seconds)
+
+
+class _Attempts:
+    """The servers a lookup tries, healthiest first, and the time each of them gets.
+
+    A lookup moves on to the next server only when one fails (SERVFAIL, REFUSED or a timeout); an
+    answer, NXDOMAIN or an empty answer is final, unless the empty answer is a referral from a zone
+    server found in authoritative mode. Each server but the last gets at most the
+    per-server timeout, all of them together at most the lifetime, and the whole list is retried
+    after timeouts. Sends are paced by the rate governor, and the wait counts against the lifetime.
+    """
+
+    def __init__(self, qname, rdtype, nameservers):
+        self.query = (qname, rdtype)
+        self.candidates = get_candidates(nameservers)
+        self.error = None
+        self.start = None
+
+    def __iter__(self):
+        for attempt in range(_policy["retries"] + 1):
+            deadline = time.monotonic() + _policy["lifetime"]
+            for index, nameserver in enumerate(self.candidates):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                delay = (
+                    rate_governor.reserve(nameserver, remaining)
+                    if _is_paced(*self.query, nameserver)
+                    else 0.0
+                )
+                if delay is None:
+                    # The server can't take the query before the deadline.
+                    continue
+                remaining -= delay
+                if index < len(self.candidates) - 1:
+                    remaining = min(_policy["timeout"], remaining)
+                _cached_answer.set(None)
+                self.start = time.perf_counter() + delay
+                yield nameserver, delay, remaining
+            if not isinstance(self.error, dns.exception.Timeout):
+                break
+
+    def succeeded(self, nameserver):
+        """Records a final response from a nameserver."""
+        _record_success(nameserver, self.start)
+        _record_outcome(*self.query, resolved=True)
+
+    def failed(self, nameserver, error):
+        """Records a failure of a nameserver."""
+        self.error = error
+        _record_failure(nameserver, self.start, error)
+
+    def raise_error(self):
+        _record_outcome(*self.query, resolved=False)
+        raise self.error or dns.exception.Timeout()
+
+
+# The servers of each zone found in authoritative mode, and the zones each server serves.
+_zone_servers = {}
+_server_zones = {}
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def register_zone_servers(zone, addresses):
+    """Makes the authoritative servers of a zone interchangeable for the names in the zone.
+
+    A lookup of such a name aimed at one of them is sent to the healthiest one first and, each time
+    HEDGE_DELAY passes without a response, to the next one as well; the first final response wins.
+    """
+    zone = zone.rstrip(".").lower()
+    _zone_servers[zone] = tuple(addresses)
+    for address in _zone_servers[zone]:
+        _server_zones[address] = _server_zones.get(address, frozenset()) | {zone}
+
+
+def get_zone_servers(qname, nameservers):
+    """Returns the servers of the zone a lookup is aimed at, healthiest first, or None if it isn't aimed at one.
+
+    A lookup is aimed at a zone if one of its nameservers is a server of a zone enclosing its
+    name, wherever that server is in the list. A server can serve several zones; the lookup
+    belongs to the closest one enclosing its name.
+    """
+    if _policy["nameservers"] or not nameservers:
+        return None
+    name = str(qname).rstrip(".").lower()
+    for nameserver in nameservers:
+        zone = max(
+            (
+                zone
+                for zone in _server_zones.get(nameserver, ())
+                if name == zone or name.endswith(f".{zone}")
+            ),
+            key=len,
+            default=None,
+        )
+        if zone:
+            return nameserver_health.rank(_zone_servers[zone])
+    return None
+
+
+def _is_lame(error):
+    # An empty answer without the AA flag from an authoritative server is a referral or a lame
+    # delegation: the server isn't authoritative for the name, so it says nothing about the record.
+    return isinstance(error, dns.resolver.NoAnswer) and not (
+        error.response().flags & dns.flags.AA
+    )
+
+
+def _query_server(qname, rdtype, nameserver, lifetime):
+    """Sends a lookup to one authoritative server and records the outcome."""
+    if _is_paced(qname, rdtype, nameserver):
+        delay = rate_governor.reserve(nameserver, lifetime)
+        if delay is None:
+            raise dns.exception.Timeout()
+        time.sleep(delay)
+        lifetime -= delay
+    _cached_answer.set(None)
+    start = time.perf_counter()
+    try:
+        try:
+            answer = get_resolver([nameserver]).resolve(
+                qname, rdtype, lifetime=lifetime
+            )
+        except dns.resolver.NoAnswer as error:
+            if _is_lame(error):
+                raise dns.resolver.NoNameservers() from error
+            raise
+    except SERVER_FAILURES as error:
+        _record_failure(nameserver, start, error)
+        raise
+    except FINAL_ERRORS:
+        _record_success(nameserver, start)
+        _record_outcome(qname, rdtype, resolved=True)
+        raise
+    _record_success(nameserver, start)
+    _record_outcome(qname, rdtype, resolved=True)
+    return _record_answer(answer)
+
+
+async def _query_server_async(qname, rdtype, nameserver, lifetime):
+    """Async counterpart of _query_server."""
+    if _is_paced(qname, rdtype, nameserver):
+        delay = rate_governor.reserve(nameserver, lifetime)
+        if delay is None:
+            raise dns.exception.Timeout()
+        await asyncio.sleep(delay)
+        lifetime -= delay
+    _cached_answer.set(None)
+    start = time.perf_counter()
+    try:
+        try:
+            answer = await get_resolver([nameserver], asynchronous=True).resolve(
+                qname, rdtype, lifetime=lifetime
+            )
+        except dns.resolver.NoAnswer as error:
+            if _is_lame(error):
+                raise dns.resolver.NoNameservers() from error
+            raise
+    except SERVER_FAILURES as error:
+        _record_failure(nameserver, start, error)
+        raise
+    except FINAL_ERRORS:
+        _record_success(nameserver, start)
+        _record_outcome(qname, rdtype, resolved=True)
+        raise
+    except asyncio.CancelledError:
+        # Outpaced by another server: the time it took so far is a lower bound of its latency.
+        _record_success(nameserver, start)
+        raise
+    _record_success(nameserver, start)
+    _record_outcome(qname, rdtype, resolved=True)
+    return _record_answer(answer)
+
+
+def _submit_hedge(fn, *args):
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(
+                max_workers=HEDGE_WORKERS, thread_name_prefix="hedge"
+            )
+    return _hedge_pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def resolve_hedged(qname, rdtype, servers, final=True):
+    """Resolves a query against interchangeable servers, with parallel fallback.
+
+    If final is False, other servers are tried after these fail, so the failure isn't recorded.
+    """
+    deadline = time.monotonic() + _policy["lifetime"]
+    servers = iter(servers)
+    pending = set()
+    error = None
+
+    def send_next():
+        nameserver = next(servers, None)
+        if nameserver is not None:
+            lifetime = deadline - time.monotonic()
+            pending.add(
+                _submit_hedge(_query_server, qname, rdtype, nameserver, lifetime)
+            )
+
+    send_next()
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(
+                pending,
+                timeout=min(HEDGE_DELAY, remaining),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                send_next()
+            for future in done:
+                pending.discard(future)
+                try:
+                    return future.result()
+                except SERVER_FAILURES as failure:
+                    error = failure
+                    send_next()
+    finally:
+        for future in pending:
+            future.cancel()
+    if final:
+        _record_outcome(qname, rdtype, resolved=False)
+    raise error or dns.exception.Timeout()
+
+
+async def resolve_hedged_async(qname, rdtype, servers, final=True):
+    """Async counterpart of resolve_hedged."""
+    deadline = time.monotonic() + _policy["lifetime"]
+    servers = iter(servers)
+    pending = set()
+    error = None
+
+    def send_next():
+        nameserver = next(servers, None)
+        if nameserver is not None:
+            lifetime = deadline - time.monotonic()
+            pending.add(
+                asyncio.ensure_future(
+                    _query_server_async(qname, rdtype, nameserver, lifetime)
+                )
+            )
+
+    send_next()
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=min(HEDGE_DELAY, remaining),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                send_next()
+            for task in done:
+                pending.discard(task)
+                try:
+                    return task.result()
+                except SERVER_FAILURES as failure:
+                    error = failure
+                    send_next()
+    finally:
+        for task in pending:
+            task.cancel()
+    if final:
+        _record_outcome(qname, rdtype, resolved=False)
+    raise error or dns.exception.Timeout()
+
+
+# Responses after which a lookup tries the next server.
+SERVER_FAILURES = (dns.exception.Timeout, dns.resolver.NoNameservers)
+# Responses that settle a lookup without an answer.
+FINAL_ERRORS = (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)
+
+
+def build_resolver(nameservers=None, asynchronous=False):
+    """Builds a resolver for a nameserver set with the configured policy and the shared cache."""
+    resolver_class = (
+        dns.asyncresolver.Resolver if asynchronous else dns.resolver.Resolver
+    )
+    resolver = resolver_class(configure=False)
+    resolver.nameservers = list(
+        _policy["nameservers"] or nameservers or get_system_nameservers()
+    )
+    resolver.port = _policy["port"]
+    resolver.timeout = _policy["timeout"]
+    resolver.lifetime = _policy["lifetime"]
+    resolver.cache = ScopedCache(nameservers[0] if nameservers else None)
+    return resolver
+
+
+def get_resolver(nameservers=None, asynchronous=False):
+    """Returns this thread's resolver for a nameserver set, building it on first use."""
+    if getattr(_resolvers, "generation", None) != _policy_generation:
+        _resolvers.generation = _policy_generation
+        _resolvers.pool = OrderedDict()
+    pool = _resolvers.pool
+    key = (tuple(nameservers) if nameservers else None, asynchronous)
+    resolver = pool.get(key)
+    if resolver is None:
+        resolver = pool[key] = build_resolver(nameservers, asynchronous)
+        if len(pool) > RESOLVER_POOL_SIZE:
+            pool.popitem(last=False)
+    else:
+        pool.move_to_end(key)
+    return resolver
+
+
+class _Flight:
+    """A lookup in flight, which identical lookups wait for instead of sending their own queries."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.answer = None
+        self.error = None
+
+
+# Lookups in flight by (name, rdtype, servers): threads share _flights, and each event loop its
+# own futures in _async_flights.
+_flights = {}
+_flights_lock = threading.Lock()
+_async_flights = {}
+
+
+def _flight_key(qname, rdtype, nameservers):
+    return (
+        str(qname).rstrip(".").lower(),
+        rdtype,
+        tuple(nameservers) if nameservers else None,
+    )
+
+
+def _follow(qname, rdtype, answer, error):
+    """Counts a lookup that shared the answer of an identical one in flight, and returns that answer."""
+    _record("coalesced")
+    if error is not None:
+        if isinstance(error, FINAL_ERRORS + SERVER_FAILURES):
+            _record_outcome(qname, rdtype, resolved=isinstance(error, FINAL_ERRORS))
+        raise error
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.record_ttl(max(0, int(answer.expiration - time.time())))
+    _record_outcome(qname, rdtype, resolved=True)
+    return answer
+
+
+def resolve(qname, rdtype, nameservers=None):
+    """Resolves a query against the given nameservers (or the system resolver), using the shared cache.
+
+    Servers are tried healthiest first, moving on only when one fails. Identical lookups made while
+    one is in flight wait for it and share its answer instead of sending their own queries.
+    """
+    _record("lookups")
+    key = _flight_key(qname, rdtype, nameservers)
+    while True:
+        with _flights_lock:
+            flight = _flights.get(key)
+            if flight is None:
+                flight = _flights[key] = _Flight()
+                break
+        flight.done.wait()
+        if flight.answer is not None or flight.error is not None:
+            return _follow(qname, rdtype, flight.answer, flight.error)
+        # The lookup in flight was interrupted; start over.
+
+    try:
+        flight.answer = _resolve(qname, rdtype, nameservers)
+        return flight.answer
+    except Exception as error:
+        flight.error = error
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _resolve(qname, rdtype, nameservers):
+    zone_servers = get_zone_servers(qname, nameservers)
+    if zone_servers:
+        # The other servers of the list, e.g. public resolvers, are tried if the zone's all fail.
+        nameservers = [ns for ns in nameservers if ns not in zone_servers]
+        if not nameservers:
+            return resolve_hedged(qname, rdtype, zone_servers)
+        try:
+            return resolve_hedged(qname, rdtype, zone_servers, final=False)
+        except SERVER_FAILURES:
+            pass
+    attempts = _Attempts(qname, rdtype, nameservers)
+    for nameserver, delay, lifetime in attempts:
+        if delay:
+            time.sleep(delay)
+        try:
+            answer = get_resolver([nameserver]).resolve(
+                qname, rdtype, lifetime=lifetime
+            )
+        except SERVER_FAILURES as error:
+            attempts.failed(nameserver, error)
+            continue
+        except FINAL_ERRORS as error:
+            if nameserver in _server_zones and _is_lame(error):
+                attempts.error = error
+                continue
+            attempts.succeeded(nameserver)
+            raise
+        attempts.succeeded(nameserver)
+        return _record_answer(answer)
+    attempts.raise_error()
+
+
+async def resolve_async(qname, rdtype, nameservers=None):
+    """Async counterpart of resolve, built on dns.asyncresolver and sharing the same cache."""
+    _record("lookups")
+    loop = asyncio.get_running_loop()
+    key = _flight_key(qname, rdtype, nameservers)
+    flight = _async_flights.get(key)
+    while flight is not None and flight.get_loop() is loop:
+        # Shielded, so that a waiter being cancelled doesn't cancel the lookup in flight.
+        answer, error = await asyncio.shield(flight)
+        if answer is not None or error is not None:
+            return _follow(qname, rdtype, answer, error)
+        flight = _async_flights.get(key)
+
+    flight = _async_flights[key] = loop.create_future()
+    answer = error = None
+    try:
+        answer = await _resolve_async(qname, rdtype, nameservers)
+        return answer
+    except Exception as lookup_error:
+        error = lookup_error
+        raise
+    finally:
+        if _async_flights.get(key) is flight:
+            del _async_flights[key]
+        flight.set_result((answer, error))
+
+
+async def _resolve_async(qname, rdtype, nameservers):
+    zone_servers = get_zone_servers(qname, nameservers)
+    if zone_servers:
+        nameservers = [ns for ns in nameservers if ns not in zone_servers]
+        if not nameservers:
+            return await resolve_hedged_async(qname, rdtype, zone_servers)
+        try:
+            return await resolve_hedged_async(
+                qname, rdtype, zone_servers, final=False
+            )
+        except SERVER_FAILURES:
+            pass
+    attempts = _Attempts(qname, rdtype, nameservers)
+    for nameserver, delay, lifetime in attempts:
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            answer = await get_resolver([nameserver], asynchronous=True).resolve(
+                qname, rdtype, lifetime=lifetime
+            )
+        except SERVER_FAILURES as error:
+            attempts.failed(nameserver, error)
+            continue
+        except FINAL_ERRORS as error:
+            if nameserver in _server_zones and _is_lame(error):
+                attempts.error = error
+                continue
+            attempts.succeeded(nameserver)
+            raise
+        attempts.succeeded(nameserver)
+        return _record_answer(answer)
+    attempts.raise_error()
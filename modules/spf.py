@@ -1,97 +1,230 @@
 # modules/spf.py
 
-import dns.resolver
+import asyncio
 import re
+import threading
+from collections import namedtuple
+
+from .resolver import FINAL_ERRORS, resolve, resolve_async, time_stage
+
+# complete is False when the lookup of a domain in the tree failed, leaving part of it unknown.
+SPFTree = namedtuple(
+    "SPFTree", ["all_mechanism", "dns_query_count", "complete"], defaults=(True,)
+)
+EMPTY_SPF_TREE = SPFTree(None, 0)
+UNKNOWN_SPF_TREE = SPFTree(None, 0, False)
+
+# Expanded trees of every domain reached through include/redirect, shared by all domains of a run.
+# Only complete trees are kept, so that a failed lookup is retried by the next domain reaching it.
+_spf_trees = {}
+_spf_trees_lock = threading.Lock()
+_expanding = threading.local()
+
+
+def spf_record_from_answer(query_result):
+    """Returns the SPF record among the TXT records of an answer, or None."""
+    for record in query_result:
+        if "spf1" in str(record):
+            return str(record).replace('"', "")
+    return None
+
+
+def lookup_spf_record(domain, nameservers=None):
+    """Returns the SPF record published by a domain, or None if it has none. Raises if the lookup failed."""
+    try:
+        return spf_record_from_answer(resolve(domain, "TXT", nameservers))
+    except FINAL_ERRORS:
+        return None
+
+
+async def lookup_spf_record_async(domain, nameservers=None):
+    """Async counterpart of lookup_spf_record."""
+    try:
+        return spf_record_from_answer(await resolve_async(domain, "TXT", nameservers))
+    except FINAL_ERRORS:
+        return None
+
+
+def fetch_spf_record(domain, nameservers=None):
+    """Returns the SPF record published by a domain, or None."""
+    try:
+        return lookup_spf_record(domain, nameservers)
+    except Exception:
+        return None
+
+
+async def fetch_spf_record_async(domain, nameservers=None):
+    """Async counterpart of fetch_spf_record."""
+    try:
+        return await lookup_spf_record_async(domain, nameservers)
+    except Exception:
+        return None
+
+
+def expand_spf(domain):
+    """Returns the SPF tree of a domain, resolving and parsing each distinct domain once per run."""
+    domain = domain.lower().rstrip(".")
+    with _spf_trees_lock:
+        tree = _spf_trees.get(domain)
+    if tree is not None:
+        return tree
+
+    in_progress = _expanding.__dict__.setdefault("domains", set())
+    if domain in in_progress:
+        return EMPTY_SPF_TREE  # Circular include or redirect
+    in_progress.add(domain)
+    try:
+        try:
+            spf_record = lookup_spf_record(domain)
+        except Exception:
+            return UNKNOWN_SPF_TREE
+        tree = expand_spf_record(spf_record) if spf_record else EMPTY_SPF_TREE
+    finally:
+        in_progress.discard(domain)
+
+    if tree.complete:
+        with _spf_trees_lock:
+            _spf_trees[domain] = tree
+    return tree
+
+
+async def expand_spf_async(domain, path=frozenset()):
+    """Async counterpart of expand_spf. Referenced domains are expanded concurrently."""
+    domain = domain.lower().rstrip(".")
+    with _spf_trees_lock:
+        tree = _spf_trees.get(domain)
+    if tree is not None:
+        return tree
+    if domain in path:
+        return EMPTY_SPF_TREE  # Circular include or redirect
+
+    try:
+        spf_record = await lookup_spf_record_async(domain)
+    except Exception:
+        return UNKNOWN_SPF_TREE
+    if spf_record:
+        tree = await expand_spf_record_async(spf_record, path | {domain})
+    else:
+        tree = EMPTY_SPF_TREE
+
+    if tree.complete:
+        with _spf_trees_lock:
+            _spf_trees[domain] = tree
+    return tree
+
+
+async def expand_spf_record_async(spf_record, path=frozenset()):
+    """Async counterpart of expand_spf_record."""
+    targets = [target for target, _ in get_spf_targets(spf_record)]
+    trees = await asyncio.gather(
+        *(expand_spf_async(target, path) for target in targets)
+    )
+    expanded = dict(zip(targets, trees))
+    return expand_spf_record(spf_record, expanded.get)
+
+
+def get_spf_targets(spf_record):
+    """Yields the domain of every include: and redirect= term, and whether it is a redirect."""
+    for item in spf_record.split():
+        if item.startswith("include:"):
+            yield item.replace("include:", ""), False
+        elif item.startswith("redirect="):
+            yield item.replace("redirect=", ""), True
+
+
+def expand_spf_record(spf_record, expand=expand_spf):
+    """Returns the 'all' mechanism and DNS query count of an SPF record, following includes and redirects."""
+    count = 0
+    complete = True
+    redirect = None
+    for target, is_redirect in get_spf_targets(spf_record):
+        tree = expand(target)
+        if is_redirect:
+            redirect = tree
+        count += 1 + tree.dns_query_count
+        complete = complete and tree.complete
+
+    # Count occurrences of 'a', 'mx', 'ptr', and 'exists' mechanisms
+    count += len(re.findall(r"[ ,+]a[ ,:]", spf_record))
+    count += len(re.findall(r"[ ,+]mx[ ,:]", spf_record))
+    count += len(re.findall(r"[ ]ptr[ ]", spf_record))
+    count += len(re.findall(r"exists[:]", spf_record))
+
+    all_matches = re.findall(r"[-~?+]all", spf_record)
+    if len(all_matches) == 1:
+        all_mechanism = all_matches[0]
+    elif len(all_matches) > 1:
+        all_mechanism = "2many"
+    elif redirect:
+        all_mechanism = redirect.all_mechanism
+    else:
+        all_mechanism = None
+
+    return SPFTree(all_mechanism, count, complete)
 
 
 class SPF:
     def __init__(self, domain, dns_server=None):
         self.domain = domain
         self.dns_server = dns_server
-        self.spf_record = self.get_spf_record()
+        with time_stage("spf"):
+            self.load(self.get_spf_record())
+
+    @classmethod
+    def from_record(cls, domain, spf_record, dns_server=None, tree=None):
+        """Builds an SPF object from an already fetched record and, optionally, its expanded tree."""
+        spf = cls.__new__(cls)
+        spf.domain = domain
+        spf.dns_server = dns_server
+        spf.load(spf_record, tree)
+        return spf
+
+    @classmethod
+    async def create_async(cls, domain, dns_server=None):
+        """Async counterpart of SPF(domain, dns_server)."""
+        spf = cls.from_record(domain, None, dns_server)
+        with time_stage("spf"):
+            spf_record = await spf.get_spf_record_async()
+            tree = await expand_spf_record_async(spf_record) if spf_record else None
+            spf.load(spf_record, tree)
+        return spf
+
+    def load(self, spf_record, tree=None):
+        """Sets the SPF record and the values derived from it."""
+        self.spf_record = spf_record
         self.all_mechanism = None
         self.spf_dns_query_count = 0
         self.too_many_dns_queries = False
+        # True if the lookup of an include or redirect failed, leaving the values above unknown.
+        self.expansion_failed = False
 
         if self.spf_record:
-            self.all_mechanism = self.get_spf_all_string()
-            self.spf_dns_query_count = self.get_spf_dns_queries()
+            if tree is None:
+                tree = expand_spf_record(self.spf_record)
+            self.all_mechanism = tree.all_mechanism
+            self.spf_dns_query_count = tree.dns_query_count
             self.too_many_dns_queries = self.spf_dns_query_count > 10
+            self.expansion_failed = not tree.complete
 
     def get_spf_record(self, domain=None):
         """Fetches the SPF record for the specified domain."""
-        try:
-            if not domain:
-                domain = self.domain
-            resolver = dns.resolver.Resolver()
-            resolver.nameservers = [self.dns_server, "1.1.1.1", "8.8.8.8"]
-            query_result = resolver.resolve(domain, "TXT")
-            for record in query_result:
-                if "spf1" in str(record):
-                    spf_record = str(record).replace('"', "")
-                    return spf_record
-            return None
-        except Exception:
-            return None
+        if not domain:
+            domain = self.domain
+        return fetch_spf_record(domain, [self.dns_server, "1.1.1.1", "8.8.8.8"])
+
+    async def get_spf_record_async(self):
+        """Async counterpart of get_spf_record."""
+        return await fetch_spf_record_async(
+            self.domain, [self.dns_server, "1.1.1.1", "8.8.8.8"]
+        )
 
     def get_spf_all_string(self):
         """Returns the string value of the 'all' mechanism in the SPF record."""
-
-        spf_record = self.spf_record
-        visited_domains = set()
-
-        while spf_record:
-            all_matches = re.findall(r"[-~?+]all", spf_record)
-            if len(all_matches) == 1:
-                return all_matches[0]
-            elif len(all_matches) > 1:
-                return "2many"
-
-            redirect_match = re.search(r"redirect=([\w.-]+)", spf_record)
-            if redirect_match:
-                redirect_domain = redirect_match.group(1)
-                if redirect_domain in visited_domains:
-                    break  # Prevent infinite loops in case of circular redirects
-                visited_domains.add(redirect_domain)
-                spf_record = self.get_spf_record(redirect_domain)
-            else:
-                break
-
-        return None
+        return expand_spf_record(self.spf_record).all_mechanism
 
     def get_spf_dns_queries(self):
         """Returns the number of dns queries, redirects, and other mechanisms in the SPF record for a given domain."""
-
-        def count_dns_queries(spf_record):
-            count = 0
-            for item in spf_record.split():
-                if item.startswith("include:") or item.startswith("redirect="):
-                    if item.startswith("include:"):
-                        url = item.replace("include:", "")
-                    elif item.startswith("redirect="):
-                        url = item.replace("redirect=", "")
-
-                    count += 1
-                    try:
-                        # Recursively fetch and count dns queries or redirects in the SPF record of the referenced domain
-                        answers = dns.resolver.resolve(url, "TXT")
-                        for rdata in answers:
-                            for txt_string in rdata.strings:
-                                txt_record = txt_string.decode("utf-8")
-                                if txt_record.startswith("v=spf1"):
-                                    count += count_dns_queries(txt_record)
-                    except Exception:
-                        pass
-
-            # Count occurrences of 'a', 'mx', 'ptr', and 'exists' mechanisms
-            count += len(re.findall(r"[ ,+]a[ ,:]", spf_record))
-            count += len(re.findall(r"[ ,+]mx[ ,:]", spf_record))
-            count += len(re.findall(r"[ ]ptr[ ]", spf_record))
-            count += len(re.findall(r"exists[:]", spf_record))
-
-            return count
-
-        return count_dns_queries(self.spf_record)
+        return expand_spf_record(self.spf_record).dns_query_count
 
     def __str__(self):
         return (
@@ -1,7 +1,29 @@
 # modules/spoofing.py
 
-import tldextract
+import os
+from itertools import product
+
 from .syntax import validate_record_syntax
+from .tld import is_subdomain
+
+SPOOFING_TYPES = {
+    0: "Spoofing possible",
+    1: "Subdomain spoofing possible",
+    2: "Organizational domain spoofing possible",
+    3: "Spoofing might be possible",
+    4: "Spoofing might be possible (Mailbox dependent)",
+    5: "Organizational domain spoofing might be possible (Mailbox dependent)",
+    6: "Subdomain spoofing might be possible (Mailbox dependent)",
+    7: "Subdomain spoofing is possible and organizational domain spoofing might be possible",
+    8: "Spoofing is not possible",
+}
+UNKNOWN_SPOOFING_TYPE = "Unknown spoofing type"
+# Verdict of a domain whose SPF or DMARC lookup failed on every server: its records are unknown,
+# and judging it as if they were missing would be wrong.
+LOOKUP_FAILED_SPOOFING_TYPE = "Spoofing could not be determined (DNS lookups failed)"
+# Verdict of a domain whose scan raised an error before its records could be judged.
+SCAN_FAILED_SPOOFING_TYPE = "Spoofing could not be determined (scan failed)"
+SPOOFING_POSSIBLE = {0: True, 1: True, 3: True, 7: True, 8: False}
 
 
 class Spoofing:
@@ -32,120 +54,31 @@ class Spoofing:
 
     def get_domain_type(self):
         """Determines whether the domain is a domain or subdomain."""
-        subdomain = bool(tldextract.extract(self.domain).subdomain)
-        return "subdomain" if subdomain else "domain"
+        return "subdomain" if is_subdomain(self.domain) else "domain"
 
     def is_spoofable(self):
         """Determines the spoofability based on DMARC and SPF data."""
         try:
-            if self.pct and int(self.pct) != 100:
-                return 3
-            if self.spf_record is None:
-                return 0 if self.p is None else 4 if self.p == "none" else 8
-            if self.spf_dns_queries > 10 and self.p is None:
-                return 0
-            if self.spf_all == "2many":
-                return 3 if self.p == "none" else 8
-            if self.spf_all and self.p is None:
-                return 0
-            if self.spf_all == "-all":
-                if self.p == "none":
-                    if self.sp == "none":
-                        if self.aspf in ["r", "s"]:
-                            return 1
-                        return 7
-                    if self.sp in ["quarantine", "reject"]:
-                        if self.aspf == "r":
-                            return 2
-                        if self.aspf == "s":
-                            return 8
-                        return 5
-                    return 4
-                if self.p in ["quarantine", "reject"]:
-                    if self.sp == "none":
-                        if self.aspf in [
-                            "r",
-                            "s",
-                        ]:
-                            return 8
-                        return 1
-                    return 8
-            if self.spf_all == "?all":
-                if not self.dmarc_record:
-                    return 0
-                if self.p == "none" and self.aspf == "r":
-                    return 0
-                if self.p == "none" and self.sp == "none" and self.aspf in ["r", "s"]:
-                    return 4
-                if self.p == "none" and self.sp in ["quarantine", "reject"]:
-                    return 5
-                return 8
-            if self.spf_all == "+all":
-                return 4
-            if self.spf_all == "~all":
-                if self.p == "none":
-                    if self.sp == "none":
-                        return 7 if self.aspf in ["r", "s"] else 0
-                    if self.sp in ["quarantine", "reject"]:
-                        return 2
-                    return 2 if self.aspf in ["r", "s"] else 0
-
-                if self.p in ["quarantine", "reject"]:
-                    if self.sp == "none":
-                        return 8 if self.aspf in ["r", "s"] else 1
-                    return 8
-            if not self.spf_all:
-                if not self.dmarc_record:
-                    return 0
-                if (
-                    self.p in ["quarantine", "reject"]
-                    and self.sp == "none"
-                    and self.aspf in ["r", "s"]
-                ):
-                    return 1
-                if self.p == "none" and self.sp in ["none", "quarantine", "reject"]:
-                    return 4 if self.aspf == "s" else 5
-                return 8
-            if not self.spf_record:
-                if not self.dmarc_record:
-                    return 0
-                if self.p == "none" and self.sp == "none" and self.aspf in ["r", "s"]:
-                    return 2
-                return 4 if self.p == "none" else 8
-            return 8
+            return VERDICT_TABLE[
+                verdict_index(
+                    self.dmarc_record,
+                    self.p,
+                    self.aspf,
+                    self.spf_record,
+                    self.spf_all,
+                    self.spf_dns_queries,
+                    self.sp,
+                    self.pct,
+                )
+            ]
         except Exception:
-            spf_valid = validate_record_syntax(self.spf_record, "SPF")
-            dmarc_valid = validate_record_syntax(self.dmarc_record, "DMARC")
-            if (not spf_valid and not dmarc_valid) or (spf_valid and not dmarc_valid):
-                return 0
-            return 3 if not spf_valid and dmarc_valid and self.p == "none" else 8
+            return fallback_verdict(self.dmarc_record, self.p, self.spf_record)
 
     def evaluate_spoofing(self):
         """Evaluates and returns whether spoofing is possible and the type of spoofing."""
-        spoofing_types = {
-            0: f"Spoofing possible for {self.domain}.",
-            1: f"Subdomain spoofing possible for {self.domain}.",
-            2: f"Organizational domain spoofing possible for {self.domain}.",
-            3: f"Spoofing might be possible for {self.domain}.",
-            4: f"Spoofing might be possible (Mailbox dependent) for {self.domain}.",
-            5: f"Organizational domain spoofing might be possible (Mailbox dependent) for {self.domain}.",
-            6: f"Subdomain spoofing might be possible (Mailbox dependent) for {self.domain}.",
-            7: f"Subdomain spoofing is possible and organizational domain spoofing might be possible for {self.domain}.",
-            8: f"Spoofing is not possible for {self.domain}.",
-        }
-
-        spoofing_type = spoofing_types.get(
-            self.spoofable, f"Unknown spoofing type for {self.domain}."
-        )
-
-        if self.spoofable in {0, 1, 3, 7}:
-            spoofing_possible = True
-        elif self.spoofable == 8:
-            spoofing_possible = False
-        else:
-            spoofing_possible = None  # "maybe"
-
-        return spoofing_possible, spoofing_type
+        spoofing_type = SPOOFING_TYPES.get(self.spoofable, UNKNOWN_SPOOFING_TYPE)
+        spoofing_possible = SPOOFING_POSSIBLE.get(self.spoofable)  # None is "maybe"
+        return spoofing_possible, f"{spoofing_type} for {self.domain}."
 
     def __str__(self):
         return (
@@ -154,3 +87,273 @@ class Spoofing:
             f"Spoofing Possible: {self.spoofing_possible}\n"
             f"Spoofing Type: {self.spoofing_type}"
         )
+
+
+def reference_verdict(
+    dmarc_record, p, aspf, spf_record, spf_all, spf_dns_queries, sp, pct
+):
+    """The spoofability rules the verdict table is compiled from. May raise on malformed values."""
+    if pct and int(pct) != 100:
+        return 3
+    if spf_record is None:
+        return 0 if p is None else 4 if p == "none" else 8
+    if spf_dns_queries > 10 and p is None:
+        return 0
+    if spf_all == "2many":
+        return 3 if p == "none" else 8
+    if spf_all and p is None:
+        return 0
+    if spf_all == "-all":
+        if p == "none":
+            if sp == "none":
+                if aspf in ["r", "s"]:
+                    return 1
+                return 7
+            if sp in ["quarantine", "reject"]:
+                if aspf == "r":
+                    return 2
+                if aspf == "s":
+                    return 8
+                return 5
+            return 4
+        if p in ["quarantine", "reject"]:
+            if sp == "none":
+                if aspf in [
+                    "r",
+                    "s",
+                ]:
+                    return 8
+                return 1
+            return 8
+    if spf_all == "?all":
+        if not dmarc_record:
+            return 0
+        if p == "none" and aspf == "r":
+            return 0
+        if p == "none" and sp == "none" and aspf in ["r", "s"]:
+            return 4
+        if p == "none" and sp in ["quarantine", "reject"]:
+            return 5
+        return 8
+    if spf_all == "+all":
+        return 4
+    if spf_all == "~all":
+        if p == "none":
+            if sp == "none":
+                return 7 if aspf in ["r", "s"] else 0
+            if sp in ["quarantine", "reject"]:
+                return 2
+            return 2 if aspf in ["r", "s"] else 0
+
+        if p in ["quarantine", "reject"]:
+            if sp == "none":
+                return 8 if aspf in ["r", "s"] else 1
+            return 8
+    if not spf_all:
+        if not dmarc_record:
+            return 0
+        if p in ["quarantine", "reject"] and sp == "none" and aspf in ["r", "s"]:
+            return 1
+        if p == "none" and sp in ["none", "quarantine", "reject"]:
+            return 4 if aspf == "s" else 5
+        return 8
+    if not spf_record:
+        if not dmarc_record:
+            return 0
+        if p == "none" and sp == "none" and aspf in ["r", "s"]:
+            return 2
+        return 4 if p == "none" else 8
+    return 8
+
+
+def fallback_verdict(dmarc_record, p, spf_record):
+    """Verdict for records whose values can't be evaluated by the rules, based on their syntax."""
+    spf_valid = validate_record_syntax(spf_record, "SPF")
+    dmarc_valid = validate_record_syntax(dmarc_record, "DMARC")
+    if (not spf_valid and not dmarc_valid) or (spf_valid and not dmarc_valid):
+        return 0
+    return 3 if not spf_valid and dmarc_valid and p == "none" else 8
+
+
+# Representative values for every input that the rules tell apart. Anything else behaves like "other".
+_PCT_VALUES = (None, 50)  # 100 (or unset) / partial enforcement
+_SPF_RECORD_VALUES = (None, "", "v=spf1")
+_SPF_QUERY_VALUES = (0, 11)  # within / over the 10 lookup limit
+_SPF_ALL_VALUES = (None, "-all", "~all", "?all", "+all", "2many", "other")
+_POLICY_VALUES = (None, "none", "quarantine", "reject", "other")
+_ASPF_VALUES = (None, "r", "s", "other")
+_DMARC_RECORD_VALUES = (None, "v=DMARC1")
+
+_SPF_ALL_INDEX = {value: index for index, value in enumerate(_SPF_ALL_VALUES)}
+_POLICY_INDEX = {value: index for index, value in enumerate(_POLICY_VALUES)}
+_ASPF_INDEX = {value: index for index, value in enumerate(_ASPF_VALUES)}
+
+
+def verdict_index(dmarc_record, p, aspf, spf_record, spf_all, spf_dns_queries, sp, pct):
+    """Normalizes the inputs into their position in VERDICT_TABLE. Raises where reference_verdict would."""
+    partial_pct = bool(pct) and int(pct) != 100
+    spf_state = 0 if spf_record is None else 2 if spf_record else 1
+    too_many_queries = (
+        not partial_pct and spf_record is not None and spf_dns_queries > 10
+    )
+    index = int(partial_pct)
+    index = index * len(_SPF_RECORD_VALUES) + spf_state
+    index = index * len(_SPF_QUERY_VALUES) + int(too_many_queries)
+    index = index * len(_SPF_ALL_VALUES) + _SPF_ALL_INDEX.get(spf_all or None, 6)
+    index = index * len(_POLICY_VALUES) + _POLICY_INDEX.get(p, 4)
+    index = index * len(_POLICY_VALUES) + _POLICY_INDEX.get(sp, 4)
+    index = index * len(_ASPF_VALUES) + _ASPF_INDEX.get(aspf, 3)
+    return index * len(_DMARC_RECORD_VALUES) + int(bool(dmarc_record))
+
+
+def compile_verdict_table():
+    """Evaluates reference_verdict once for every normalized combination of inputs."""
+    return bytes(
+        reference_verdict(
+            dmarc_record, p, aspf, spf_record, spf_all, spf_dns_queries, sp, pct
+        )
+        for pct, spf_record, spf_dns_queries, spf_all, p, sp, aspf, dmarc_record in product(
+            _PCT_VALUES,
+            _SPF_RECORD_VALUES,
+            _SPF_QUERY_VALUES,
+            _SPF_ALL_VALUES,
+            _POLICY_VALUES,
+            _POLICY_VALUES,
+            _ASPF_VALUES,
+            _DMARC_RECORD_VALUES,
+        )
+    )
+
+
+VERDICT_TABLE = compile_verdict_table()
+
+
+# The master table shipped with the package, found from this module so any working directory works.
+MASTER_TABLE_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "files",
+    "Master_Table.xlsx",
+)
+
+
+def check_master_table(file_name=MASTER_TABLE_FILE):
+    """Returns the (SPF, DMARC, expected, compiled) rows of the master table whose code differs from the table."""
+    import pandas as pd
+
+    all_mechanisms = {
+        "-all": "-all",
+        "all-": "-all",
+        "all~": "~all",
+        "all?": "?all",
+        "all+": "+all",
+    }
+    mismatches = []
+    for spf, dmarc, expected in pd.read_excel(file_name).itertuples(index=False):
+        spf_all = all_mechanisms.get(spf)
+        spf_record = None if spf == "No SPF" else f"v=spf1 {spf_all or ''}".strip()
+        tags = {}
+        if dmarc != "No DMARC":
+            tags = dict(tag.strip().split("=", 1) for tag in dmarc.split(","))
+        verdict = VERDICT_TABLE[
+            verdict_index(
+                None if dmarc == "No DMARC" else dmarc,
+                tags.get("p"),
+                tags.get("aspf"),
+                spf_record,
+                spf_all,
+                0,
+                tags.get("sp"),
+                tags.get("pct"),
+            )
+        ]
+        if verdict != expected:
+            mismatches.append((spf, dmarc, expected, verdict))
+    return mismatches
+
+
+def evaluate_frame(frame):
+    """Vectorized Spoofing over many rows at once.
+
+    Takes a DataFrame (or a dict of column arrays) with the columns report.write_to_excel emits
+    and returns a DataFrame with the SPOOFING_POSSIBLE and SPOOFING_TYPE columns, giving the same
+    results as Spoofing for every row. Missing values (NaN) are treated as None.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if not isinstance(frame, pd.DataFrame):
+        frame = pd.DataFrame(frame)
+
+    def digits(column, digit):
+        # Evaluates digit() once per distinct value; -1 marks values the rules would raise on.
+        codes, uniques = pd.factorize(frame[column], use_na_sentinel=False)
+        values = []
+        for value in uniques:
+            try:
+                values.append(digit(None if pd.isna(value) else value))
+            except (TypeError, ValueError):
+                values.append(-1)
+        return np.asarray(values, dtype=np.int64)[codes]
+
+    partial_pct = digits("DMARC_PCT", lambda pct: int(bool(pct) and int(pct) != 100))
+    spf_state = digits(
+        "SPF", lambda record: 0 if record is None else 2 if record else 1
+    )
+    over_limit = digits("SPF_NUM_DNS_QUERIES", lambda queries: int(queries > 10))
+    spf_all = digits(
+        "SPF_MULTIPLE_ALLS", lambda value: _SPF_ALL_INDEX.get(value or None, 6)
+    )
+    p = digits("DMARC_POLICY", lambda value: _POLICY_INDEX.get(value, 4))
+    sp = digits("DMARC_SP", lambda value: _POLICY_INDEX.get(value, 4))
+    aspf = digits("DMARC_ASPF", lambda value: _ASPF_INDEX.get(value, 3))
+    has_dmarc = digits("DMARC", lambda record: int(bool(record)))
+
+    # The query count is only compared when pct is fully enforced and an SPF record exists.
+    compared = (partial_pct == 0) & (spf_state != 0)
+    too_many_queries = np.where(compared, over_limit, 0)
+    failed = (partial_pct < 0) | (too_many_queries < 0)
+
+    index = partial_pct
+    index = index * len(_SPF_RECORD_VALUES) + spf_state
+    index = index * len(_SPF_QUERY_VALUES) + too_many_queries
+    index = index * len(_SPF_ALL_VALUES) + spf_all
+    index = index * len(_POLICY_VALUES) + p
+    index = index * len(_POLICY_VALUES) + sp
+    index = index * len(_ASPF_VALUES) + aspf
+    index = index * len(_DMARC_RECORD_VALUES) + has_dmarc
+
+    table = np.frombuffer(VERDICT_TABLE, dtype=np.uint8)
+    verdicts = table[np.where(failed, 0, index)].astype(np.int64)
+    failed_rows = np.flatnonzero(failed)
+    if len(failed_rows):
+        fallbacks = {}
+        records = zip(
+            *(
+                frame[column].to_numpy(dtype=object)[failed_rows]
+                for column in ("DMARC", "DMARC_POLICY", "SPF")
+            )
+        )
+        for row, values in zip(failed_rows, records):
+            values = tuple(None if pd.isna(value) else value for value in values)
+            if values not in fallbacks:
+                fallbacks[values] = fallback_verdict(*values)
+            verdicts[row] = fallbacks[values]
+
+    codes = range(max(SPOOFING_TYPES) + 2)
+    type_lookup = np.array(
+        [SPOOFING_TYPES.get(code, UNKNOWN_SPOOFING_TYPE) + " for " for code in codes],
+        dtype=object,
+    )
+    possible_lookup = np.array(
+        [SPOOFING_POSSIBLE.get(code) for code in codes], dtype=object
+    )
+    verdicts = np.minimum(verdicts, len(codes) - 1)
+    return pd.DataFrame(
+        {
+            "SPOOFING_POSSIBLE": possible_lookup[verdicts],
+            "SPOOFING_TYPE": type_lookup[verdicts]
+            + frame["DOMAIN"].astype(str).to_numpy(dtype=object)
+            + ".",
+        },
+        index=frame.index,
+    )
@@ -0,0 +1,94 @@
+# modules/store.py
+
+import json
+import sqlite3
+import threading
+import time
+
+# Raw record data compared between scans to decide whether a domain changed.
+RECORD_FIELDS = ["SPF", "DMARC", "BIMI_RECORD", "DKIM"]
+COMMIT_INTERVAL = 100
+
+
+class ResultStore:
+    """Persistent, SQLite-backed store of the last result of every domain."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                domain TEXT PRIMARY KEY,
+                checked_at REAL NOT NULL,
+                changed_at REAL NOT NULL,
+                ttl INTEGER,
+                spf TEXT,
+                dmarc TEXT,
+                bimi TEXT,
+                dkim TEXT,
+                spoofing_possible INTEGER,
+                spoofing_type TEXT,
+                result TEXT NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+    def get_fresh(self, domain, max_age):
+        """Returns the stored result of a domain if it was checked less than max_age seconds ago."""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT result FROM results WHERE domain = ? AND checked_at >= ?",
+                (domain, time.time() - max_age),
+            ).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[0])
+        result["DNS_QUERIES"] = 0
+        return result
+
+    def save(self, result):
+        """Stores a result. The change time moves only when the records or the verdict changed."""
+        now = time.time()
+        records = [_to_text(result.get(field)) for field in RECORD_FIELDS]
+        # An include or redirect target can change the verdict while the records stay the same.
+        verdict = [result.get("SPOOFING_POSSIBLE"), result.get("SPOOFING_TYPE")]
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT spf, dmarc, bimi, dkim, spoofing_possible, spoofing_type, changed_at"
+                " FROM results WHERE domain = ?",
+                (result["DOMAIN"],),
+            ).fetchone()
+            changed_at = now
+            if row is not None and list(row[:-1]) == records + verdict:
+                changed_at = row[-1]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    result["DOMAIN"],
+                    now,
+                    changed_at,
+                    result.get("DNS_MIN_TTL"),
+                    *records,
+                    *verdict,
+                    json.dumps(result, default=str),
+                ),
+            )
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self.connection.commit()
+                self._pending = 0
+
+    def close(self):
+        """Commits pending changes and closes the database."""
+        with self._lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def _to_text(value):
+    return None if value is None else str(value)
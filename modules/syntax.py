@@ -1,96 +1,137 @@
 # modules/syntax.py
 import re
+from collections import namedtuple
+
+# A problem found in a record: the index of the term, the term itself and what is wrong with it.
+SyntaxIssue = namedtuple("SyntaxIssue", ["position", "term", "message"])
+
+SPF_MECHANISM_PATTERNS = {
+    mechanism: re.compile(pattern)
+    for mechanism, pattern in {
+        "all": r"^all$",
+        "include": r"^include:[\w\.\-]+\.[a-zA-Z]{2,}$",
+        "a": r"^a(:[\w\.\-]+)?$",
+        "mx": r"^mx(:[\w\.\-]+)?$",
+        "ptr": r"^ptr(:[\w\.\-]+)?$",
+        "ip4": r"^ip4:(\d{1,3}\.){3}\d{1,3}(\/\d{1,2})?$",
+        "ip6": r"^ip6:[a-fA-F0-9:]+(\/\d{1,3})?$",
+        "exists": r"^exists:[\w\.\-]+\.[a-zA-Z]{2,}$",
+    }.items()
+}
+
+SPF_MODIFIER_PATTERNS = {
+    modifier: re.compile(pattern)
+    for modifier, pattern in {
+        "redirect": r"^redirect=[\w\.\-]+\.[a-zA-Z]{2,}$",
+        "exp": r"^exp=[\w\.\-]+\.[a-zA-Z]{2,}$",
+    }.items()
+}
+
+DMARC_TAG_PATTERNS = {
+    tag: re.compile(pattern)
+    for tag, pattern in {
+        "v": r"^DMARC1$",
+        "p": r"^(none|quarantine|reject)$",
+        "sp": r"^(none|quarantine|reject)$",
+        "pct": r"^(100|[1-9]?[0-9])$",
+        "rua": r"^[\w\.\-]+@[\w\.\-]+\.[a-zA-Z]{2,}$",
+        "ruf": r"^[\w\.\-]+@[\w\.\-]+\.[a-zA-Z]{2,}$",
+        "rf": r"^(afrf)$",
+        "fo": r"^(0|1|d|s)$",
+        "ri": r"^\d+$",
+        "aspf": r"^(r|s)$",
+        "adkim": r"^(r|s)$",
+    }.items()
+}
+
+
+def split_tags(record):
+    """Yields the (name, value) pairs of a tag-value record (DMARC, BIMI) in order, in one pass.
+
+    Names are lowercased and both parts are stripped; a term without "=" has a value of None.
+    """
+    for term in record.split(";"):
+        name, separator, value = term.partition("=")
+        name = name.strip()
+        if name or separator:
+            yield name.lower(), value.strip() if separator else None
+
+
+def parse_tags(record):
+    """Returns the tags of a tag-value record as a dict. The first occurrence of a tag wins."""
+    tags = {}
+    for name, value in split_tags(record):
+        if value is not None and name not in tags:
+            tags[name] = value
+    return tags
+
+
+def check_record_syntax(record, record_type):
+    """Checks the syntax of a DNS record (SPF or DMARC) and returns a list of SyntaxIssue, empty if it is valid."""
+    if not isinstance(record, str):
+        return [SyntaxIssue(0, record, "record is not a string")]
+    if record_type == "SPF":
+        return _check_spf(record)
+    if record_type == "DMARC":
+        return _check_dmarc(record)
+    return [SyntaxIssue(0, record, f"unknown record type {record_type}")]
 
 
 def validate_record_syntax(record, record_type):
     """Validate the syntax of a DNS record (SPF or DMARC)."""
-
-    if record_type == "SPF":
-        mechanism_patterns = {
-            "all": r"^all$",
-            "include": r"^include:[\w\.\-]+\.[a-zA-Z]{2,}$",
-            "a": r"^a(:[\w\.\-]+)?$",
-            "mx": r"^mx(:[\w\.\-]+)?$",
-            "ptr": r"^ptr(:[\w\.\-]+)?$",
-            "ip4": r"^ip4:(\d{1,3}\.){3}\d{1,3}(\/\d{1,2})?$",
-            "ip6": r"^ip6:[a-fA-F0-9:]+(\/\d{1,3})?$",
-            "exists": r"^exists:[\w\.\-]+\.[a-zA-Z]{2,}$",
-        }
-
-        modifier_patterns = {
-            "redirect": r"^redirect=[\w\.\-]+\.[a-zA-Z]{2,}$",
-            "exp": r"^exp=[\w\.\-]+\.[a-zA-Z]{2,}$",
-        }
-
-        elements = record.split()
-
-        if len(elements) == 0 or elements[0].strip().lower() != "v=spf1":
-            return False
-
-        for element in elements[1:]:
-            element = element.strip()
-
-            if ":" in element:
-                mechanism, value = element.split(":", 1)
-            elif "=" in element:
-                modifier, value = element.split("=", 1)
-                mechanism = modifier
-            else:
-                mechanism = element
-                value = None
-
-            if mechanism in mechanism_patterns:
-                pattern = mechanism_patterns[mechanism]
-                if value:
-                    if not re.match(pattern, element):
-                        return False
-                elif not re.match(r"^" + mechanism + r"$", element):
-                    return False
-
-            elif mechanism in modifier_patterns:
-                pattern = modifier_patterns[mechanism]
-                if not re.match(pattern, element):
-                    return False
-            else:
-                return False
-    elif record_type == "DMARC":
-        tag_patterns = {
-            "v": r"^DMARC1$",
-            "p": r"^(none|quarantine|reject)$",
-            "sp": r"^(none|quarantine|reject)$",
-            "pct": r"^(100|[1-9]?[0-9])$",
-            "rua": r"^[\w\.\-]+@[\w\.\-]+\.[a-zA-Z]{2,}$",
-            "ruf": r"^[\w\.\-]+@[\w\.\-]+\.[a-zA-Z]{2,}$",
-            "rf": r"^(afrf)$",
-            "fo": r"^(0|1|d|s)$",
-            "ri": r"^\d+$",
-            "aspf": r"^(r|s)$",
-            "adkim": r"^(r|s)$",
-        }
-
-        tags = record.split(";")
-
-        if len(tags) < 2 or not tags[0].strip().startswith("v=DMARC1"):
-            return False
-
-        for tag in tags:
-            tag = tag.strip()
-            if not tag:
-                continue
-            tag_key_value = tag.split("=")
-
-            if len(tag_key_value) != 2:
-                return False
-
-            tag_key, tag_value = tag_key_value
-            tag_key = tag_key.lower().strip()
-            tag_value = tag_value.strip()
-
-            if tag_key in tag_patterns:
-                if not re.match(tag_patterns[tag_key], tag_value):
-                    return False
+    return not check_record_syntax(record, record_type)
+
+
+def _check_spf(record):
+    elements = record.split()
+    if len(elements) == 0 or elements[0].lower() != "v=spf1":
+        return [SyntaxIssue(0, elements[0] if elements else "", "missing v=spf1")]
+
+    issues = []
+    for position, element in enumerate(elements[1:], 1):
+        if ":" in element:
+            mechanism, value = element.split(":", 1)
+        elif "=" in element:
+            mechanism, value = element.split("=", 1)
+        else:
+            mechanism, value = element, None
+
+        if mechanism in SPF_MECHANISM_PATTERNS:
+            if value:
+                valid = SPF_MECHANISM_PATTERNS[mechanism].match(element)
             else:
-                return False
-    else:
-        return False
-    return True
+                valid = element == mechanism
+            if not valid:
+                issues.append(
+                    SyntaxIssue(position, element, f"invalid {mechanism} mechanism")
+                )
+        elif mechanism in SPF_MODIFIER_PATTERNS:
+            if not SPF_MODIFIER_PATTERNS[mechanism].match(element):
+                issues.append(
+                    SyntaxIssue(position, element, f"invalid {mechanism} modifier")
+                )
+        else:
+            issues.append(SyntaxIssue(position, element, "unknown term"))
+    return issues
+
+
+def _check_dmarc(record):
+    if ";" not in record:
+        return [SyntaxIssue(0, record, "record has a single tag")]
+
+    # The record must start with v=DMARC1 as written: lowercase v, with no empty term before it.
+    first = record.split(";", 1)[0].strip()
+    issues = []
+    if not first.startswith("v=DMARC1"):
+        issues.append(SyntaxIssue(0, first, "first tag is not v=DMARC1"))
+    for position, (tag_key, tag_value) in enumerate(split_tags(record)):
+        term = tag_key if tag_value is None else f"{tag_key}={tag_value}"
+        if position == 0 and issues:
+            continue
+        if tag_value is None:
+            issues.append(SyntaxIssue(position, term, "missing ="))
+        elif tag_key not in DMARC_TAG_PATTERNS:
+            issues.append(SyntaxIssue(position, term, "unknown tag"))
+        elif not DMARC_TAG_PATTERNS[tag_key].match(tag_value):
+            issues.append(SyntaxIssue(position, term, f"invalid {tag_key} value"))
+    return issues
@@ -0,0 +1,29 @@
+# modules/tld.py
+
+from functools import lru_cache
+
+import tldextract
+
+# Uses the public suffix list snapshot bundled with tldextract and never goes to the network,
+# so air-gapped scanners don't stall on the first lookup.
+_extractor = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+
+
+@lru_cache(maxsize=65536)
+def split_domain(domain):
+    """Returns the (subdomain, registered domain) parts of a domain."""
+    extracted = _extractor(domain)
+    registered_domain = ""
+    if extracted.domain and extracted.suffix:
+        registered_domain = f"{extracted.domain}.{extracted.suffix}"
+    return extracted.subdomain, registered_domain
+
+
+def get_registered_domain(domain):
+    """Returns the registered (organizational) domain of a domain, or an empty string if it has none."""
+    return split_domain(domain)[1]
+
+
+def is_subdomain(domain):
+    """Returns True if the domain has labels below its registered domain."""
+    return bool(split_domain(domain)[0])
@@ -6,6 +6,7 @@ setup(
     packages=[ "modules", "files" ],
     py_modules=["spoofy"],
     install_requires=[ "colorama", "dnspython>= 2.2.1", "tldextract", "pandas", "openpyxl" ],
+    extras_require={ "parquet": [ "pyarrow" ] },
     entry_points={ "console_scripts": [ "spoofy=spoofy:main" ] }
 )
 
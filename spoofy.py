@@ -2,25 +2,63 @@
 
 # spoofy.py
 import argparse
+import asyncio
+import itertools
+import sys
 import threading
+from contextlib import ExitStack, suppress
 from queue import Queue
-from modules.dns import DNS
-from modules.spf import SPF
-from modules.dmarc import DMARC
+
+from modules import authoritative, dkim, report, resolver
 from modules.dkim import DKIM
-from modules.bimi import BIMI
-from modules.spoofing import Spoofing
-from modules import report
+from modules.dns import DNS, prefetch_organization, prefetch_organization_async
+from modules.metrics import MetricsRecorder
+from modules.spoofing import (
+    LOOKUP_FAILED_SPOOFING_TYPE,
+    SCAN_FAILED_SPOOFING_TYPE,
+    Spoofing,
+)
+from modules.store import ResultStore
+from modules.tld import get_registered_domain
 
-print_lock = threading.Lock()
+# Domains read from the input at a time to be grouped by organization.
+DEFAULT_GROUP_WINDOW = 1000
 
 
-def process_domain(domain, enable_dkim=False):
+def process_domain(domain, enable_dkim=False, metrics=None):
     """Process a domain to gather DNS, SPF, DMARC, and BIMI records. Optionally enumerate DKIM selectors if enabled."""
-    dns_info = DNS(domain)
-    spf = SPF(domain, dns_info.dns_server)
-    dmarc = DMARC(domain, dns_info.dns_server)
-    bimi_info = BIMI(domain, dns_info.dns_server)
+    with resolver.track_queries() as query_stats, resolver.time_stage("total"):
+        dkim_info = resolver.submit(DKIM, domain) if enable_dkim else None
+        dns_info = DNS(domain)
+        dkim_record = dkim_info.result().dkim_record if dkim_info else None
+
+    if metrics:
+        metrics.record(domain, query_stats)
+    return build_result(domain, dns_info, dkim_record, query_stats)
+
+
+async def process_domain_async(domain, enable_dkim=False, metrics=None):
+    """Async counterpart of process_domain. DKIM enumeration runs alongside the DNS lookups."""
+    with resolver.track_queries() as query_stats, resolver.time_stage("total"):
+        if enable_dkim:
+            dns_info, dkim_info = await asyncio.gather(
+                DNS.create_async(domain), asyncio.to_thread(DKIM, domain)
+            )
+            dkim_record = dkim_info.dkim_record
+        else:
+            dns_info = await DNS.create_async(domain)
+            dkim_record = None
+
+    if metrics:
+        metrics.record(domain, query_stats)
+    return build_result(domain, dns_info, dkim_record, query_stats)
+
+
+def build_result(domain, dns_info, dkim_record, query_stats):
+    """Evaluates the gathered records of a domain and returns its result dict."""
+    spf = dns_info.spf_record
+    dmarc = dns_info.dmarc_record
+    bimi_info = dns_info.bimi_record
 
     spf_record = spf.spf_record
     spf_all = spf.all_mechanism
@@ -35,11 +73,6 @@ def process_domain(domain, enable_dkim=False):
     dmarc_fo = dmarc.fo
     dmarc_rua = dmarc.rua
 
-    dkim_record = None
-    if enable_dkim:
-        dkim = DKIM(domain, dns_info.dns_server)
-        dkim_record = dkim.dkim_record
-
     bimi_record = bimi_info.bimi_record
     bimi_version = bimi_info.version
     bimi_location = bimi_info.location
@@ -60,6 +93,18 @@ def process_domain(domain, enable_dkim=False):
     domain_type = spoofing_info.domain_type
     spoofing_possible = spoofing_info.spoofing_possible
     spoofing_type = spoofing_info.spoofing_type
+    # The verdict rests on the SPF record and its includes and redirects, and on the DMARC record,
+    # which subdomains take from their organizational domain.
+    if (
+        (spf_record is None and query_stats.is_unresolved(domain, "TXT"))
+        or spf.expansion_failed
+        or (
+            dmarc_record is None
+            and query_stats.is_unresolved(f"_dmarc.{dmarc.get_dmarc_domain()}", "TXT")
+        )
+    ):
+        spoofing_possible = None
+        spoofing_type = f"{LOOKUP_FAILED_SPOOFING_TYPE} for {domain}."
 
     result = {
         "DOMAIN": domain,
@@ -83,23 +128,218 @@ def process_domain(domain, enable_dkim=False):
         "BIMI_AUTHORITY": bimi_authority,
         "SPOOFING_POSSIBLE": spoofing_possible,
         "SPOOFING_TYPE": spoofing_type,
+        "DNS_QUERIES": query_stats.queries,
+        "DNS_MIN_TTL": query_stats.min_ttl,
+        "DNS_FAILURES": len(query_stats.unresolved),
     }
     return result
 
 
-def worker(domain_queue, print_lock, output, results, enable_dkim=False):
-    """Worker function to process domains and output results."""
+def failed_result(domain, error):
+    """Returns the result of a domain whose scan raised, reporting the error on stderr."""
+    print(f"[!] Scanning {domain} failed: {error!r}", file=sys.stderr)
+    result = dict.fromkeys(report.RESULT_SCHEMA)
+    result["DOMAIN"] = domain
+    result["SPOOFING_TYPE"] = f"{SCAN_FAILED_SPOOFING_TYPE} for {domain}: {error!r}."
+    return result
+
+
+def worker(
+    domain_queue, writer, enable_dkim=False, store=None, max_age=None, metrics=None
+):
+    """Worker function to process domains and output results.
+
+    Returns the number of domains whose scan failed; their results are still written.
+    """
+    failures = 0
     while True:
         domain = domain_queue.get()
         if domain is None:
-            break
-        result = process_domain(domain, enable_dkim=enable_dkim)
-        with print_lock:
-            if output == "stdout":
-                report.printer(**result)
-            else:
-                results.append(result)
-        domain_queue.task_done()
+            return failures
+        try:
+            result = store.get_fresh(domain, max_age) if store and max_age else None
+            if result is None:
+                result = process_domain(
+                    domain, enable_dkim=enable_dkim, metrics=metrics
+                )
+                # Results with failed lookups are rescanned next time rather than stored.
+                if store and not result["DNS_FAILURES"]:
+                    store.save(result)
+        # A dead worker would leave the producer blocked on the bounded queue.
+        except Exception as error:  # noqa: BLE001
+            failures += 1
+            result = failed_result(domain, error)
+        writer.write(result)
+
+
+def read_domains(file):
+    """Yields the domains of an open list file one at a time, skipping blank lines."""
+    for line in file:
+        domain = line.strip()
+        if domain:
+            yield domain
+
+
+def group_by_organization(domains, window=DEFAULT_GROUP_WINDOW):
+    """Yields the domains in windows of up to `window`, each as a list of (registered domain, domains) groups.
+
+    Reading a window at a time keeps huge inputs streaming. Within a window, groups keep the order
+    in which their first domain appeared.
+    """
+    domains = iter(domains)
+    while True:
+        batch = list(itertools.islice(domains, window))
+        if not batch:
+            return
+        groups = {}
+        for domain in batch:
+            organization = get_registered_domain(domain) or domain
+            groups.setdefault(organization, []).append(domain)
+        yield list(groups.items())
+
+
+def schedule_domains(domains, group_window=0):
+    """Yields the domains to process, grouped by organization if group_window is set.
+
+    The records shared by a group of several domains are resolved once, in the shared lookup pool
+    alongside the rest of the window, before the group's domains are handed out. These prefetch
+    queries aren't counted in any domain's DNS_QUERIES or DNS_FAILURES, only in the run totals.
+    A failed prefetch is ignored: the group's domains then look the records up themselves.
+    """
+    if not group_window:
+        yield from domains
+        return
+    for groups in group_by_organization(domains, group_window):
+        prefetches = [
+            (
+                resolver.submit(prefetch_organization, organization)
+                if len(group) > 1
+                else None
+            )
+            for organization, group in groups
+        ]
+        for (organization, group), prefetch in zip(groups, prefetches):
+            if prefetch:
+                # The prefetch only warms the cache, so any error is left to the domains' own lookups.
+                with suppress(Exception):
+                    prefetch.result()
+            yield from group
+
+
+async def schedule_domains_async(domains, group_window=0):
+    """Async counterpart of schedule_domains."""
+    if not group_window:
+        for domain in domains:
+            yield domain
+        return
+    for groups in group_by_organization(domains, group_window):
+        prefetches = [
+            (
+                asyncio.create_task(prefetch_organization_async(organization))
+                if len(group) > 1
+                else None
+            )
+            for organization, group in groups
+        ]
+        for (organization, group), prefetch in zip(groups, prefetches):
+            if prefetch:
+                with suppress(Exception):
+                    await prefetch
+            for domain in group:
+                yield domain
+
+
+def run_threads(
+    domains,
+    writer,
+    enable_dkim=False,
+    thread_count=4,
+    store=None,
+    max_age=None,
+    metrics=None,
+    group_window=0,
+):
+    """Processes domains with a pool of worker threads fed from a bounded queue.
+
+    Returns the number of domains whose scan failed; their results are still written.
+    """
+    # Bounded so that a huge input is read only as fast as the workers consume it.
+    domain_queue = Queue(maxsize=thread_count * 4)
+    failures = []
+
+    threads = []
+    for _ in range(thread_count):
+        thread = threading.Thread(
+            target=lambda: failures.append(
+                worker(domain_queue, writer, enable_dkim, store, max_age, metrics)
+            ),
+        )
+        thread.start()
+        threads.append(thread)
+
+    # The workers are stopped even if reading the input fails, which is then re-raised.
+    try:
+        for domain in schedule_domains(domains, group_window):
+            domain_queue.put(domain)
+    finally:
+        for _ in range(len(threads)):
+            domain_queue.put(None)
+        for thread in threads:
+            thread.join()
+    return sum(failures)
+
+
+async def run_async(
+    domains,
+    writer,
+    enable_dkim=False,
+    concurrency=1000,
+    store=None,
+    max_age=None,
+    metrics=None,
+    group_window=0,
+):
+    """Processes domains on one event loop, keeping at most `concurrency` domains in flight.
+
+    Returns the number of domains whose scan failed; their results are still written.
+    """
+    in_flight = asyncio.Semaphore(concurrency)
+    tasks = set()
+    failures = 0
+
+    async def run(domain):
+        nonlocal failures
+        try:
+            result = store.get_fresh(domain, max_age) if store and max_age else None
+            if result is None:
+                result = await process_domain_async(
+                    domain, enable_dkim=enable_dkim, metrics=metrics
+                )
+                if store and not result["DNS_FAILURES"]:
+                    store.save(result)
+        # One domain's error must not drop it from the output or stop the others.
+        except Exception as error:  # noqa: BLE001
+            failures += 1
+            result = failed_result(domain, error)
+        finally:
+            in_flight.release()
+        writer.write(result)
+
+    async for domain in schedule_domains_async(domains, group_window):
+        await in_flight.acquire()
+        task = asyncio.create_task(run(domain))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    return failures
+
+
+def positive_float(value):
+    """Argument type for rates, which must be greater than zero."""
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got {value}")
+    return number
 
 
 def main():
@@ -114,9 +354,15 @@ def main():
     parser.add_argument(
         "-o",
         type=str,
-        choices=["stdout", "xls", "json"],
+        choices=["stdout", "xls", "json", "jsonl", "csv", "parquet"],
         default="stdout",
-        help="Output format: stdout or xls (default: stdout).",
+        help="Output format: stdout, xls, json, jsonl, csv or parquet (default: stdout). json, jsonl and csv are written to stdout as each domain completes; parquet is written to output.parquet in batches and requires pyarrow.",
+    )
+    parser.add_argument(
+        "--color",
+        choices=["auto", "always", "never"],
+        default="auto",
+        help="Color the stdout output: auto colors it only when stdout is a terminal (default: auto).",
     )
     parser.add_argument(
         "-t", type=int, default=4, help="Number of threads to use (default: 4)"
@@ -124,41 +370,186 @@ def main():
     parser.add_argument(
         "--dkim", action="store_true", help="Enable DKIM selector enumeration via API"
     )
+    parser.add_argument(
+        "--dkim-probe",
+        action="store_true",
+        help="Enable DKIM selector enumeration by probing common selectors over DNS (can be combined with --dkim)",
+    )
+    parser.add_argument(
+        "--dkim-selectors",
+        type=str,
+        help="File of selectors to probe, one per line, instead of the built-in list. Implies --dkim-probe.",
+    )
+    parser.add_argument(
+        "--dkim-max-selectors",
+        type=int,
+        default=dkim.DEFAULT_MAX_SELECTORS,
+        help=f"Stop probing a domain once this many selectors are found, 0 for no limit (default: {dkim.DEFAULT_MAX_SELECTORS}).",
+    )
+    parser.add_argument(
+        "--dkim-rate",
+        type=positive_float,
+        default=dkim.DEFAULT_API_RATE,
+        help=f"Maximum DKIM API requests per second (default: {dkim.DEFAULT_API_RATE}).",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["thread", "async"],
+        default="thread",
+        help="Scanning engine: a pool of -t threads, or asyncio (default: thread).",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1000,
+        help="Maximum number of domains in flight with --engine async (default: 1000).",
+    )
+    parser.add_argument(
+        "--group-window",
+        type=int,
+        default=DEFAULT_GROUP_WINDOW,
+        help=f"With -iL, read this many domains at a time and group them by registered domain, resolving the records an organization's subdomains share once per group; 0 keeps the input order (default: {DEFAULT_GROUP_WINDOW}). The queries resolving these shared records count toward the run totals but not toward any domain's DNS_QUERIES or DNS_FAILURES.",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        help="SQLite file keeping the last result of every domain between runs.",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=int,
+        help="With --store, reuse stored results checked less than this many seconds ago instead of rescanning.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        nargs="?",
+        const="",
+        metavar="FILE",
+        help="Print a summary of per-stage wall time, queries, timeouts and answering nameservers at the end. With FILE, also write one JSON line of metrics per domain to it.",
+    )
+    parser.add_argument(
+        "--resolvers",
+        type=lambda value: [server.strip() for server in value.split(",")],
+        help="Comma-separated recursive resolvers to use instead of the public and system ones, e.g. internal resolvers. Lookups go to the healthiest one.",
+    )
+    parser.add_argument(
+        "--authoritative",
+        action="store_true",
+        help="Query each domain's authoritative nameservers directly, found from its zone's NS records, instead of its SOA server. A server that is slow or fails falls back to the zone's other servers in parallel.",
+    )
+    parser.add_argument(
+        "--dns-rate",
+        type=float,
+        default=resolver.DEFAULT_SERVER_RATE,
+        help="Maximum DNS queries per second sent to each server, 0 for no cap (default: 0). Servers whose error rate spikes are slowed down regardless, and sped up again as they recover.",
+    )
+    parser.add_argument(
+        "--dns-timeout",
+        type=float,
+        default=resolver.DEFAULT_LIFETIME,
+        help=f"Seconds to wait for each DNS lookup across all its servers (default: {resolver.DEFAULT_LIFETIME}).",
+    )
+    parser.add_argument(
+        "--dns-retries",
+        type=int,
+        default=resolver.DEFAULT_RETRIES,
+        help=f"Times a DNS lookup is retried after timing out (default: {resolver.DEFAULT_RETRIES}).",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=resolver.DEFAULT_CACHE_SIZE,
+        help=f"Maximum number of DNS answers kept in the shared cache (default: {resolver.DEFAULT_CACHE_SIZE}).",
+    )
 
     args = parser.parse_args()
+    if args.max_age is not None and not args.store:
+        parser.error("--max-age requires --store")
+    resolver.set_cache_size(args.cache_size)
+    resolver.configure(
+        lifetime=args.dns_timeout, retries=args.dns_retries, resolvers=args.resolvers
+    )
+    resolver.set_server_rate(args.dns_rate)
+    authoritative.configure(enabled=args.authoritative)
+    resolver.set_lookup_workers(max(resolver.DEFAULT_LOOKUP_WORKERS, args.t * 3))
+    dkim.set_api_rate(args.dkim_rate)
+    dkim_probe = args.dkim_probe or args.dkim_selectors is not None
+    if dkim_probe:
+        dkim.configure(
+            use_api=args.dkim,
+            selectors=(
+                dkim.read_selectors(args.dkim_selectors)
+                if args.dkim_selectors
+                else dkim.DEFAULT_SELECTORS
+            ),
+            max_selectors=args.dkim_max_selectors,
+        )
+    enable_dkim = args.dkim or dkim_probe
 
+    group_window = 0
+    input_file = None
     if args.d:
         domains = [args.d]
     elif args.iL:
-        with open(args.iL, "r") as file:
-            domains = [line.strip() for line in file]
-
-    domain_queue = Queue()
-    results = []
+        # Opened up front so that a missing file is reported before any scanning starts; the
+        # ExitStack below closes it.
+        try:
+            input_file = open(args.iL, "r")  # noqa: SIM115
+        except OSError as error:
+            parser.error(f"cannot open -iL file: {error}")
+        domains = read_domains(input_file)
+        group_window = args.group_window
 
-    for domain in domains:
-        domain_queue.put(domain)
-
-    threads = []
-    for _ in range(min(args.t, len(domains))):
-        thread = threading.Thread(
-            target=worker, args=(domain_queue, print_lock, args.o, results, args.dkim)
+    try:
+        writer = report.open_writer(
+            args.o, {"auto": None, "always": True, "never": False}[args.color]
         )
-        thread.start()
-        threads.append(thread)
-
-    domain_queue.join()
-
-    if args.o == "xls" and results:
-        report.write_to_excel(results)
-        print("Results written to output.xlsx")
-    elif args.o == "json" and results:
-        report.output_json(results)
+    except ImportError as error:
+        parser.error(str(error))
+    store = ResultStore(args.store) if args.store else None
+    metrics = (
+        MetricsRecorder(args.metrics or None) if args.metrics is not None else None
+    )
+    # Output, store and metrics file are closed even if the run fails.
+    with ExitStack() as resources:
+        if input_file:
+            resources.enter_context(input_file)
+        resources.callback(writer.close)
+        if store:
+            resources.callback(store.close)
+        if metrics:
+            resources.enter_context(metrics)
+        if args.engine == "async":
+            failures = asyncio.run(
+                run_async(
+                    domains,
+                    writer,
+                    enable_dkim,
+                    args.concurrency,
+                    store,
+                    args.max_age,
+                    metrics,
+                    group_window,
+                )
+            )
+        else:
+            failures = run_threads(
+                domains,
+                writer,
+                enable_dkim,
+                args.t,
+                store,
+                args.max_age,
+                metrics,
+                group_window,
+            )
 
-    for _ in range(len(threads)):
-        domain_queue.put(None)
-    for thread in threads:
-        thread.join()
+    report.print_summary(resolver.totals)
+    if metrics:
+        report.print_metrics(metrics)
+    if failures:
+        sys.exit(f"[!] Scanning failed for {failures} domains.")
 
 
 if __name__ == "__main__":
@@ -1,5 +1,52 @@
+import argparse
+import asyncio
+import csv
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import dns.exception
+import dns.resolver
+from openpyxl import load_workbook
+import spoofy
+from benchmark import StubDNSServer, build_zones
+from modules import authoritative, metrics, report, resolver, spf, spoofing, syntax, tld
+from modules.bimi import BIMI
+from modules.dkim import DKIM, TokenBucket
+from modules.dmarc import DMARC
+from modules.dns import DNS
+from modules.resolver import QueryStats
+from modules.spf import SPF
 from modules.spoofing import Spoofing
+from modules.store import ResultStore
+
+
+def start_stub(test, records, **kwargs):
+    """Starts a stub DNS server that is stopped when the test ends."""
+    stub = StubDNSServer(records, **kwargs).start()
+    test.addCleanup(stub.stop)
+    return stub
+
+
+def reset_resolver(test, **policy):
+    """Configures the resolver for a test with an empty answer cache and SPF memo, all restored when it ends."""
+    test.addCleanup(resolver.configure)
+    for patcher in (
+        mock.patch.dict(resolver._policy),
+        mock.patch.object(resolver, "answer_cache", resolver.AnswerCache(10000)),
+        mock.patch.object(spf, "_spf_trees", {}),
+    ):
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    resolver.configure(**policy)
 
 
 class TestSpoofy(unittest.TestCase):
@@ -424,5 +471,1008 @@ class TestSpoofy(unittest.TestCase):
         self.assertEqual(spoofing.spoofable, 0)
 
 
+class TestVerdictTable(unittest.TestCase):
+    def test_table_matches_reference_rules(self):
+        values = [
+            [None, "", "v=DMARC1"],
+            [None, "", "none", "quarantine", "reject", "bogus"],
+            [None, "r", "s", "x"],
+            [None, "", "v=spf1 -all"],
+            [None, "", "-all", "~all", "?all", "+all", "2many", "all"],
+            [0, 11, None],
+            [None, "none", "quarantine", "reject", "z"],
+            [None, 0, "100", 50, "abc"],
+        ]
+        raising = 0
+        for combination in itertools.product(*values):
+            try:
+                expected = spoofing.reference_verdict(*combination)
+            except (TypeError, ValueError):
+                # The compiled table must reject the same malformed values.
+                with self.assertRaises((TypeError, ValueError), msg=combination):
+                    spoofing.verdict_index(*combination)
+                raising += 1
+                continue
+            compiled = spoofing.VERDICT_TABLE[spoofing.verdict_index(*combination)]
+            self.assertEqual(compiled, expected, combination)
+        self.assertTrue(raising)
+
+    def test_evaluate_frame_matches_spoofing(self):
+        values = [
+            [None, "", "v=spf1 -all"],
+            [None, "-all", "~all", "?all", "+all", "2many"],
+            [0, 11],
+            [None, "v=DMARC1; p=none"],
+            [None, "none", "quarantine", "reject"],
+            [None, "none", "reject"],
+            [None, "r", "s"],
+            [None, "100", "50", "abc"],
+        ]
+        columns = [
+            "SPF",
+            "SPF_MULTIPLE_ALLS",
+            "SPF_NUM_DNS_QUERIES",
+            "DMARC",
+            "DMARC_POLICY",
+            "DMARC_SP",
+            "DMARC_ASPF",
+            "DMARC_PCT",
+        ]
+        rows = [
+            dict(zip(columns, combination))
+            for combination in itertools.product(*values)
+        ]
+        for number, row in enumerate(rows):
+            row["DOMAIN"] = f"row{number}.example.com"
+        evaluated = spoofing.evaluate_frame(
+            {column: [row[column] for row in rows] for column in columns + ["DOMAIN"]}
+        )
+        for row, possible, spoofing_type in zip(
+            rows, evaluated["SPOOFING_POSSIBLE"], evaluated["SPOOFING_TYPE"]
+        ):
+            expected = Spoofing(
+                row["DOMAIN"],
+                row["DMARC"],
+                row["DMARC_POLICY"],
+                row["DMARC_ASPF"],
+                row["SPF"],
+                row["SPF_MULTIPLE_ALLS"],
+                row["SPF_NUM_DNS_QUERIES"],
+                row["DMARC_SP"],
+                row["DMARC_PCT"],
+            )
+            self.assertEqual(
+                (possible, spoofing_type),
+                (expected.spoofing_possible, expected.spoofing_type),
+                row,
+            )
+
+    def test_master_table_mismatches_are_known(self):
+        # Rows where the spreadsheet disagrees with the rules of Spoofing, which the table
+        # compiles; the code is the reference. A change here means the rules changed.
+        known = [
+            ("-all", "p=quarantine, sp=none, aspf=r", 1, 8),
+            ("-all", "p=reject, sp=none, aspf=r", 1, 8),
+            ("all?", "p=quarantine, sp=none, aspf=r", 1, 8),
+            ("all?", "p=quarantine, sp=none, aspf=s", 1, 8),
+            ("all?", "p=reject, sp=none, aspf=r", 1, 8),
+            ("all?", "p=reject, sp=none, aspf=s", 1, 8),
+            ("all?", "p=none", 4, 8),
+            ("all?", "p=none, sp=none", 4, 8),
+            ("all?", "p=none, aspf=s", 4, 8),
+            ("all?", "p=none, sp=quarantine, aspf=r", 5, 0),
+            ("all?", "p=none, sp=reject, aspf=r", 5, 0),
+            ("all?", "p=quarantine, sp=none", 6, 8),
+            ("all?", "p=reject, sp=none", 6, 8),
+            ("all+", "No DMARC", 4, 0),
+            ("No All", "p=none, aspf=r", 0, 8),
+            ("No All", "p=none, sp=none, aspf=r", 0, 5),
+            ("No All", "p=none", 4, 8),
+            ("No All", "p=none, sp=none", 4, 5),
+            ("No All", "p=none, aspf=s", 4, 8),
+            ("No All", "p=none, sp=quarantine, aspf=s", 5, 4),
+            ("No All", "p=none, sp=reject, aspf=s", 5, 4),
+            ("No All", "p=quarantine, sp=none", 6, 8),
+            ("No All", "p=reject, sp=none", 6, 8),
+            ("No SPF", "p=none, sp=none, aspf=r", 2, 4),
+            ("No SPF", "p=none, sp=none, aspf=s", 2, 4),
+            ("No SPF", "p=none, sp=none", 8, 4),
+            ("No SPF", "p=none, sp=quarantine", 8, 4),
+            ("No SPF", "p=none, sp=reject", 8, 4),
+            ("No SPF", "p=none, aspf=r", 8, 4),
+            ("No SPF", "p=none, aspf=s", 8, 4),
+            ("No SPF", "p=none, sp=quarantine, aspf=r", 8, 4),
+            ("No SPF", "p=none, sp=quarantine, aspf=s", 8, 4),
+            ("No SPF", "p=none, sp=reject, aspf=r", 8, 4),
+            ("No SPF", "p=none, sp=reject, aspf=s", 8, 4),
+        ]
+        self.assertEqual(spoofing.check_master_table(), known)
+
+    def test_failed_lookups_make_the_verdict_unknown(self):
+        stub = start_stub(
+            self,
+            {
+                ("include.com", "TXT"): ['"v=spf1 include:flaky.net -all"'],
+                ("_dmarc.include.com", "TXT"): ['"v=DMARC1; p=reject"'],
+                ("mail.organization.com", "TXT"): ['"v=spf1 -all"'],
+                ("healthy.com", "TXT"): ['"v=spf1 -all"'],
+                ("_dmarc.healthy.com", "TXT"): ['"v=DMARC1; p=reject"'],
+            },
+            failing={"flaky.net", "_dmarc.organization.com"},
+        )
+        reset_resolver(self, nameservers=["127.0.0.1"], port=stub.port, retries=0)
+
+        for domain in ("include.com", "mail.organization.com"):
+            result = spoofy.process_domain(domain)
+            self.assertIsNone(result["SPOOFING_POSSIBLE"], domain)
+            self.assertTrue(
+                result["SPOOFING_TYPE"].startswith(spoofing.LOOKUP_FAILED_SPOOFING_TYPE)
+            )
+            self.assertGreater(result["DNS_FAILURES"], 0)
+        self.assertFalse(spoofy.process_domain("healthy.com")["SPOOFING_POSSIBLE"])
+
+
+class TestSPF(unittest.TestCase):
+    def test_expansion_is_memoized(self):
+        records = {
+            "a.test": "v=spf1 include:shared.test -all",
+            "b.test": "v=spf1 include:shared.test mx ~all",
+            "shared.test": "v=spf1 include:leaf.test a ?all",
+            "leaf.test": "v=spf1 ip4:192.0.2.1 -all",
+        }
+        with mock.patch.object(spf, "_spf_trees", {}), mock.patch.object(
+            spf, "lookup_spf_record", side_effect=records.get
+        ) as fetch:
+            tree_a = spf.expand_spf_record(records["a.test"])
+            tree_b = spf.expand_spf_record(records["b.test"])
+        self.assertEqual(tree_a, spf.SPFTree("-all", 3))
+        self.assertEqual(tree_b, spf.SPFTree("~all", 4))
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_redirect_all_mechanism_and_loops(self):
+        records = {
+            "loop.test": "v=spf1 include:loop.test redirect=target.test",
+            "target.test": "v=spf1 -all",
+        }
+        with mock.patch.object(spf, "_spf_trees", {}), mock.patch.object(
+            spf, "lookup_spf_record", side_effect=records.get
+        ):
+            tree = spf.expand_spf("loop.test")
+        self.assertEqual(tree.all_mechanism, "-all")
+
+    def test_failed_lookups_are_reported_and_not_memoized(self):
+        stub = start_stub(
+            self,
+            {("a.test", "TXT"): ['"v=spf1 include:flaky.test -all"']},
+            failing={"flaky.test"},
+        )
+        reset_resolver(self, nameservers=["127.0.0.1"], port=stub.port, retries=0)
+
+        for _ in range(2):
+            with resolver.track_queries() as query_stats:
+                tree = spf.expand_spf("a.test")
+            self.assertEqual(tree, spf.SPFTree("-all", 1, False))
+            self.assertTrue(query_stats.is_unresolved("flaky.test", "TXT"))
+        self.assertEqual(spf._spf_trees, {})
+
+
+class TestTLD(unittest.TestCase):
+    def test_split_domain(self):
+        self.assertEqual(
+            tld.split_domain("mail.example.co.uk"), ("mail", "example.co.uk")
+        )
+        self.assertEqual(tld.get_registered_domain("example.com"), "example.com")
+        self.assertFalse(tld.is_subdomain("example.com"))
+
+
+class TestTags(unittest.TestCase):
+    def test_dmarc_tags_are_not_mixed_up(self):
+        record = "v=DMARC1; sp=none; p=reject; fo=1:d; ruf=mailto:f@example.com"
+        dmarc = DMARC.from_record("example.com", record)
+        self.assertEqual(dmarc.policy, "reject")
+        self.assertEqual(dmarc.sp, "none")
+        self.assertEqual(dmarc.fo, "mailto:f@example.com")
+        self.assertIsNone(dmarc.pct)
+        self.assertTrue(syntax.validate_record_syntax("v=DMARC1; p=none", "DMARC"))
+        self.assertFalse(syntax.validate_record_syntax("p=none; v=DMARC1", "DMARC"))
+
+    def test_bimi_record_is_unquoted(self):
+        bimi = BIMI.from_record(
+            "example.com",
+            BIMI.bimi_record_from_answer(
+                ['"v=BIMI1; l=https://x/l.svg; a=https://x/a.pem"']
+            ),
+        )
+        self.assertEqual(
+            bimi.bimi_record, "v=BIMI1; l=https://x/l.svg; a=https://x/a.pem"
+        )
+        self.assertEqual(bimi.authority, "https://x/a.pem")
+
+
+class TestSyntax(unittest.TestCase):
+    def test_issues_name_the_invalid_terms(self):
+        issues = syntax.check_record_syntax("v=spf1 include: mx ip4:1.2.3", "SPF")
+        self.assertEqual([issue.term for issue in issues], ["include:", "ip4:1.2.3"])
+        issues = syntax.check_record_syntax("v=DMARC1; p=maybe; pct=50", "DMARC")
+        self.assertEqual(issues, [syntax.SyntaxIssue(1, "p=maybe", "invalid p value")])
+        self.assertFalse(syntax.validate_record_syntax(None, "SPF"))
+
+    def test_dmarc_version_must_come_first_as_written(self):
+        for record in ("V=DMARC1; p=none", "; v=DMARC1; p=none", "p=none; v=DMARC1"):
+            issues = syntax.check_record_syntax(record, "DMARC")
+            self.assertEqual(
+                [issue.message for issue in issues], ["first tag is not v=DMARC1"]
+            )
+        self.assertTrue(syntax.validate_record_syntax("v=DMARC1 ;p=none", "DMARC"))
+
+
+class TestDNS(unittest.TestCase):
+    def test_spf_and_dmarc_are_fetched_concurrently(self):
+        stub = start_stub(
+            self,
+            {
+                ("example.com", "TXT"): ['"v=spf1 -all"'],
+                ("_dmarc.example.com", "TXT"): ['"v=DMARC1; p=reject"'],
+                ("default._bimi.example.com", "TXT"): [
+                    '"v=BIMI1; l=https://x/l.svg; a=https://x/a.pem"'
+                ],
+            },
+        )
+        reset_resolver(self, nameservers=["127.0.0.1"], port=stub.port)
+        # Each lookup waits for the other to start, which happens only if both run at once.
+        started = threading.Barrier(2, timeout=5)
+
+        def concurrent(record_class):
+            def build(*args):
+                started.wait()
+                return record_class(*args)
+
+            return build
+
+        with mock.patch("modules.dns.SPF", concurrent(SPF)), mock.patch(
+            "modules.dns.DMARC", concurrent(DMARC)
+        ):
+            dns_info = DNS("example.com", lookup=False)
+            self.assertTrue(dns_info.get_records("127.0.0.1"))
+        self.assertEqual(dns_info.spf_record.all_mechanism, "-all")
+        self.assertEqual(dns_info.dmarc_record.policy, "reject")
+        self.assertEqual(dns_info.bimi_record.location, "https://x/l.svg")
+        self.assertEqual(dns_info.bimi_record.authority, "https://x/a.pem")
+
+
+class TestDKIM(unittest.TestCase):
+    def test_retries_rate_limited_requests_and_caches(self):
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(self.path)
+                if len(requests_seen) == 1:
+                    self.send_response(429)
+                    self.send_header("Retry-After", "0")
+                    self.end_headers()
+                    return
+                body = json.dumps(
+                    [{"selector": "s1", "domain": "example.com", "value": "p=abc"}]
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        api_base_url = f"http://127.0.0.1:{server.server_port}/api"
+
+        record = DKIM("example.com", api_base_url=api_base_url).dkim_record
+        self.assertEqual(record, "[*]    s1._domainkey.example.com -> p=abc")
+        DKIM("example.com", api_base_url=api_base_url)
+        self.assertEqual(requests_seen, ["/api/key?domain=example.com"] * 2)
+
+    def test_probe_selectors_stops_once_enough_are_found(self):
+        published = {"k1", "s1", "google"}
+
+        def resolve(qname, rdtype, nameservers=None):
+            selector = qname.split(".")[0]
+            if selector == "revoked":
+                return [mock.Mock(strings=[b"v=DKIM1; k=rsa; p="])]
+            if selector not in published:
+                raise dns.resolver.NXDOMAIN()
+            return [mock.Mock(strings=[b"v=DKIM1; k=rsa; ", b"p=abc"])]
+
+        with mock.patch("modules.dkim.resolve", side_effect=resolve):
+            dkim_info = DKIM.__new__(DKIM)
+            dkim_info.domain = "example.com"
+            dkim_info.dns_server = None
+            found = dkim_info.probe_selectors(["google", "x", "revoked", "k1", "s1"], 0)
+            self.assertEqual([r["selector"] for r in found], ["google", "k1", "s1"])
+            self.assertEqual(found[0]["value"], "v=DKIM1; k=rsa; p=abc")
+            self.assertEqual(len(dkim_info.probe_selectors(["k1", "s1"], 1)), 1)
+
+    def test_duplicates_without_last_seen_are_formatted(self):
+        dkim_info = DKIM.__new__(DKIM)
+        dkim_info.domain = "example.com"
+        records = [
+            {"selector": "s1", "value": "p=old", "lastSeenAt": None},
+            {"selector": "s1", "value": "p=new", "lastSeenAt": "2024-01-01T00:00:00Z"},
+            {"selector": "s1", "value": "p=none", "lastSeenAt": None},
+        ]
+        self.assertEqual(
+            dkim_info.format_dkim_records(records),
+            "[*]    s1._domainkey.example.com -> p=new",
+        )
+
+    def test_api_rate_must_be_positive(self):
+        self.assertEqual(spoofy.positive_float("0.5"), 0.5)
+        for value in ("0", "-1"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                spoofy.positive_float(value)
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+
+class TestReport(unittest.TestCase):
+    def test_excel_writer_appends(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        file_name = os.path.join(directory.name, "output.xlsx")
+        with mock.patch("builtins.print"):
+            report.write_to_excel(
+                [
+                    {"DOMAIN": "a.com", "SPF": None},
+                    {"DOMAIN": "b.com", "SPF": "v=spf1"},
+                ],
+                file_name,
+            )
+            report.write_to_excel(
+                [{"DOMAIN": "c.com", "SPF": "x", "DKIM": 1}], file_name
+            )
+        rows = list(load_workbook(file_name).active.iter_rows(values_only=True))
+        self.assertEqual(
+            rows,
+            [
+                ("DOMAIN", "SPF", "DKIM"),
+                ("a.com", None, None),
+                ("b.com", "v=spf1", None),
+                ("c.com", "x", 1),
+            ],
+        )
+
+    def test_stdout_writer_prints_whole_blocks_without_colors(self):
+        stream = io.StringIO()
+        writer = report.StdoutWriter(stream)
+        for domain in ["a.com", "b.com"]:
+            writer.write({"DOMAIN": domain, "SPOOFING_TYPE": "Spoofing possible."})
+        writer.close()
+        self.assertEqual(
+            stream.getvalue().split("\n\n")[0].splitlines()[:2],
+            ["[*] Domain: a.com", "[*] Is subdomain: False"],
+        )
+        self.assertNotIn("\x1b", stream.getvalue())
+        self.assertIn("\x1b", report.render_result({"DOMAIN": "a.com"}, color=True))
+
+    def test_forced_colors_survive_a_pipe(self):
+        script = (
+            "from modules import report\n"
+            "writer = report.StdoutWriter(color=True)\n"
+            "writer.write({'DOMAIN': 'a.com'})\n"
+            "writer.close()\n"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        self.assertIn("Domain: a.com", output)
+        self.assertIn("\x1b", output)
+
+    def test_columnar_writers_follow_the_result_schema(self):
+        dns_info = DNS("example.com", lookup=False)
+        dns_info.spf_record = SPF.from_record(
+            "example.com", "v=spf1 -all", tree=spf.EMPTY_SPF_TREE
+        )
+        dns_info.dmarc_record = DMARC.from_record("example.com", "v=DMARC1; p=reject")
+        dns_info.bimi_record = BIMI.from_record("example.com", None)
+        result = spoofy.build_result("example.com", dns_info, None, QueryStats())
+        self.assertEqual(list(result), list(report.RESULT_SCHEMA))
+
+        stream = io.StringIO()
+        writer = report.CSVWriter(stream)
+        writer.write(result)
+        rows = list(csv.DictReader(io.StringIO(stream.getvalue())))
+        self.assertEqual(rows[0]["DMARC_POLICY"], "reject")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        file_name = os.path.join(directory.name, "output.parquet")
+        try:
+            writer = report.ParquetWriter(file_name, batch_size=2)
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+        with mock.patch("builtins.print"):
+            for _ in range(3):
+                writer.write(result)
+            writer.close()
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(file_name)
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column("SPOOFING_POSSIBLE").to_pylist(), [False] * 3)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stages_are_timed_per_domain_and_aggregated(self):
+        with resolver.track_queries() as query_stats:
+            with resolver.time_stage("spf"):
+                pass
+            with resolver.time_stage("spf"):
+                time.sleep(0.03)
+        self.assertGreaterEqual(query_stats.stages["spf"], 0.03)
+
+        recorder = metrics.MetricsRecorder()
+        recorder.record("example.com", query_stats)
+        bucket = metrics.bucket_index(query_stats.stages["spf"])
+        self.assertEqual(recorder.histograms["spf"][bucket], 1)
+        self.assertEqual(sum(recorder.histograms["spf"]), 1)
+        self.assertEqual(recorder.domains, 1)
+
+    def test_metrics_file_is_closed_when_the_run_fails(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        file_name = os.path.join(directory.name, "metrics.jsonl")
+        recorder = metrics.MetricsRecorder(file_name)
+        with self.assertRaises(RuntimeError), recorder:
+            recorder.record("example.com", QueryStats())
+            raise RuntimeError
+        self.assertIsNone(recorder.file)
+        with open(file_name) as file:
+            self.assertEqual(json.loads(file.read())["DOMAIN"], "example.com")
+
+
+class TestResolverReuse(unittest.TestCase):
+    def test_each_thread_reuses_one_resolver_per_nameserver_set(self):
+        reset_resolver(self)
+        first = resolver.get_resolver(["192.0.2.1"])
+        self.assertIs(resolver.get_resolver(["192.0.2.1"]), first)
+        self.assertIsNot(resolver.get_resolver(["192.0.2.2"]), first)
+        self.assertEqual(
+            resolver.get_resolver(["192.0.2.2"]).nameservers, ["192.0.2.2"]
+        )
+
+        other_thread = []
+        thread = threading.Thread(
+            target=lambda: other_thread.append(resolver.get_resolver(["192.0.2.1"]))
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_thread[0], first)
+
+        # A new policy replaces the resolvers built under the old one.
+        resolver.configure(retries=0)
+        self.assertIsNot(resolver.get_resolver(["192.0.2.1"]), first)
+
+
+class TestNameserverSelection(unittest.TestCase):
+    def test_fails_over_only_on_server_failures(self):
+        responses = {}
+
+        def get_resolver(nameservers, asynchronous=False):
+            def resolve(qname, rdtype, lifetime=None):
+                response = responses[nameservers[0]]
+                if isinstance(response, Exception):
+                    # Failing servers are slow, so that latency noise can't reorder the ranking.
+                    time.sleep(0.01)
+                    raise response
+                return response
+
+            return mock.Mock(resolve=resolve)
+
+        answer = mock.Mock(expiration=time.time() + 60, nameserver="10.0.0.2")
+        health = resolver.NameserverHealth()
+        with mock.patch.dict(
+            resolver._policy, {"resolvers": ["10.0.0.1", "10.0.0.2"]}
+        ), mock.patch.object(resolver, "nameserver_health", health), mock.patch.object(
+            resolver, "get_resolver", get_resolver
+        ):
+            responses["10.0.0.1"] = dns.resolver.NoNameservers()
+            responses["10.0.0.2"] = answer
+            self.assertIs(resolver.resolve("example.com", "TXT", ["1.1.1.1"]), answer)
+            self.assertEqual(resolver.get_candidates(), ["10.0.0.2", "10.0.0.1"])
+
+            responses["10.0.0.2"] = dns.resolver.NXDOMAIN()
+            responses["10.0.0.1"] = answer
+            with self.assertRaises(dns.resolver.NXDOMAIN):
+                resolver.resolve("example.com", "TXT")
+            self.assertEqual(
+                resolver.get_candidates(["192.0.2.1", "8.8.8.8"]),
+                ["192.0.2.1", "10.0.0.2", "10.0.0.1"],
+            )
+
+
+class TestRateGovernor(unittest.TestCase):
+    def test_backs_off_on_error_spikes_and_recovers(self):
+        health = resolver.NameserverHealth()
+        governor = resolver.RateGovernor(max_rate=100)
+        with mock.patch.object(resolver, "nameserver_health", health):
+            self.assertEqual(governor.reserve("10.0.0.1"), 0.0)
+            self.assertAlmostEqual(governor.reserve("10.0.0.1"), 0.01, places=2)
+            self.assertIsNone(governor.reserve("10.0.0.1", max_delay=0.01))
+            for _ in range(100):
+                governor.record_sent("10.0.0.1")
+            for _ in range(3):
+                health.record("10.0.0.1", 1.0, failed=True)
+                governor.failed("10.0.0.1", 1.0)
+        self.assertEqual(governor.rates["10.0.0.1"], 50)
+
+        governor.backoff_at["10.0.0.1"] -= 2
+        governor.changed_at["10.0.0.1"] -= 2
+        governor.reserve("10.0.0.1")
+        self.assertAlmostEqual(governor.rates["10.0.0.1"], 60.5, places=0)
+
+    def test_failed_lookups_are_unresolved_not_missing(self):
+        def get_resolver(nameservers, asynchronous=False):
+            return mock.Mock(resolve=mock.Mock(side_effect=responses.pop(0)))
+
+        responses = [dns.exception.Timeout(), dns.resolver.NoAnswer()]
+        with mock.patch.dict(
+            resolver._policy, {"nameservers": ["10.0.0.1"]}
+        ), mock.patch.object(
+            resolver, "get_resolver", get_resolver
+        ), resolver.track_queries() as stats:
+            with self.assertRaises(dns.exception.Timeout):
+                resolver.resolve("Example.com", "TXT")
+            self.assertTrue(stats.is_unresolved("example.com", "TXT"))
+            with self.assertRaises(dns.resolver.NoAnswer):
+                resolver.resolve("example.com", "TXT")
+            self.assertFalse(stats.is_unresolved("example.com", "TXT"))
+
+
+class TestCoalescing(unittest.TestCase):
+    def test_identical_lookups_in_flight_share_one_query(self):
+        answer = mock.Mock(expiration=time.time() + 60, nameserver="10.0.0.1")
+        release = threading.Event()
+        calls = []
+
+        def get_resolver(nameservers, asynchronous=False):
+            def resolve(qname, rdtype, lifetime=None):
+                calls.append(qname)
+                release.wait(5)
+                return answer
+
+            async def resolve_async(qname, rdtype, lifetime=None):
+                calls.append(qname)
+                await asyncio.sleep(0.05)
+                return answer
+
+            return mock.Mock(resolve=resolve_async if asynchronous else resolve)
+
+        async def resolve_all():
+            return await asyncio.gather(
+                *(resolver.resolve_async("async.example", "TXT") for _ in range(5))
+            )
+
+        with mock.patch.dict(
+            resolver._policy, {"nameservers": ["10.0.0.1"]}
+        ), mock.patch.object(resolver, "get_resolver", get_resolver):
+            results = []
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(
+                        resolver.resolve("sync.example", "TXT")
+                    )
+                )
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, [answer] * 5)
+
+            self.assertEqual(asyncio.run(resolve_all()), [answer] * 5)
+        self.assertEqual(calls, ["sync.example", "async.example"])
+
+
+class TestAuthoritative(unittest.TestCase):
+    def test_zone_servers_are_cached_and_queried_with_fallback(self):
+        records = {
+            ("example.com", "NS"): [mock.Mock(target="ns1.example.net.")],
+            ("ns1.example.net.", "A"): ["192.0.2.1", "192.0.2.2"],
+        }
+        lookups = []
+
+        def resolve(qname, rdtype, nameservers=None):
+            lookups.append((qname, rdtype))
+            if (qname, rdtype) not in records:
+                raise dns.resolver.NoAnswer()
+            return records[(qname, rdtype)]
+
+        with mock.patch.dict(authoritative._zones, clear=True), mock.patch.dict(
+            resolver._zone_servers, clear=True
+        ), mock.patch.dict(resolver._server_zones, clear=True), mock.patch.object(
+            authoritative, "resolve", resolve
+        ):
+            servers = authoritative.get_zone_servers("mail.example.com")
+            self.assertEqual(servers, ("192.0.2.1", "192.0.2.2"))
+            self.assertEqual(authoritative.get_zone_servers("example.com"), servers)
+            self.assertEqual(len(lookups), 3)
+
+            def get_resolver(nameservers, asynchronous=False):
+                def resolve(qname, rdtype, lifetime=None):
+                    if nameservers[0] == "192.0.2.1":
+                        raise dns.resolver.NoNameservers()
+                    return answer
+
+                return mock.Mock(resolve=resolve)
+
+            answer = mock.Mock(expiration=time.time() + 60, nameserver="192.0.2.2")
+            with mock.patch.object(
+                resolver, "nameserver_health", resolver.NameserverHealth()
+            ), mock.patch.object(resolver, "get_resolver", get_resolver):
+                self.assertIs(
+                    resolver.resolve("example.com", "TXT", ["192.0.2.1"]), answer
+                )
+
+    def test_programming_errors_are_not_taken_for_missing_servers(self):
+        with mock.patch.dict(authoritative._zones, clear=True), mock.patch.object(
+            authoritative, "resolve", side_effect=TypeError
+        ), self.assertRaises(TypeError):
+            authoritative.get_zone_servers("example.com")
+
+    def test_zones_sharing_a_server_keep_their_own_servers(self):
+        with mock.patch.dict(resolver._zone_servers, clear=True), mock.patch.dict(
+            resolver._server_zones, clear=True
+        ):
+            resolver.register_zone_servers("example.com", ["192.0.2.1", "192.0.2.2"])
+            resolver.register_zone_servers("example.org", ["192.0.2.1", "192.0.2.3"])
+            self.assertEqual(
+                set(resolver.get_zone_servers("mail.example.com", ["192.0.2.1"])),
+                {"192.0.2.1", "192.0.2.2"},
+            )
+            self.assertEqual(
+                set(resolver.get_zone_servers("example.org", ["192.0.2.1"])),
+                {"192.0.2.1", "192.0.2.3"},
+            )
+            self.assertIsNone(resolver.get_zone_servers("example.net", ["192.0.2.1"]))
+
+    def test_lookups_with_public_fallbacks_are_hedged_across_the_zone(self):
+        failing = {"192.0.2.1"}
+        asked = []
+
+        def get_resolver(nameservers, asynchronous=False):
+            def resolve(qname, rdtype, lifetime=None):
+                asked.append(nameservers[0])
+                if nameservers[0] in failing:
+                    raise dns.resolver.NoNameservers()
+                return mock.Mock(
+                    expiration=time.time() + 60, nameserver=nameservers[0]
+                )
+
+            return mock.Mock(resolve=resolve)
+
+        servers = ["192.0.2.1", "1.1.1.1", "8.8.8.8"]
+        with mock.patch.dict(resolver._zone_servers, clear=True), mock.patch.dict(
+            resolver._server_zones, clear=True
+        ), mock.patch.object(
+            resolver, "nameserver_health", resolver.NameserverHealth()
+        ), mock.patch.object(
+            resolver, "answer_cache", resolver.AnswerCache(100)
+        ), mock.patch.object(resolver, "get_resolver", get_resolver):
+            resolver.register_zone_servers("example.com", ["192.0.2.1", "192.0.2.2"])
+            self.assertEqual(
+                set(resolver.get_zone_servers("example.com", servers)),
+                {"192.0.2.1", "192.0.2.2"},
+            )
+            answer = resolver.resolve("example.com", "TXT", servers)
+            self.assertEqual(answer.nameserver, "192.0.2.2")
+            self.assertNotIn("1.1.1.1", asked)
+
+            # The public resolvers are asked only once every zone server failed.
+            failing.add("192.0.2.2")
+            answer = resolver.resolve("www.example.com", "TXT", servers)
+            self.assertEqual(answer.nameserver, "1.1.1.1")
+
+    def test_lame_replies_from_zone_servers_are_not_cached(self):
+        def answer(flags):
+            return mock.Mock(
+                expiration=time.time() + 60, response=mock.Mock(flags=flags)
+            )
+
+        key = (dns.name.from_text("example.com"), dns.rdatatype.TXT, dns.rdataclass.IN)
+        cache = resolver.ScopedCache("192.0.2.1")
+        with mock.patch.object(
+            resolver, "answer_cache", resolver.AnswerCache(10)
+        ), mock.patch.dict(resolver._server_zones, {"192.0.2.1": {"example.com"}}):
+            cache.put(key, answer(0))
+            self.assertIsNone(cache.get(key))
+            authoritative_answer = answer(dns.flags.AA)
+            cache.put(key, authoritative_answer)
+            self.assertIs(cache.get(key), authoritative_answer)
+
+
+class TestScheduling(unittest.TestCase):
+    def test_groups_windows_by_organization_and_prefetches_once(self):
+        domains = [
+            "a.example.com",
+            "other.org",
+            "b.example.com",
+            "example.com",
+            "c.x.io",
+        ]
+        self.assertEqual(
+            list(spoofy.group_by_organization(domains, window=4)),
+            [
+                [
+                    ("example.com", ["a.example.com", "b.example.com", "example.com"]),
+                    ("other.org", ["other.org"]),
+                ],
+                [("x.io", ["c.x.io"])],
+            ],
+        )
+
+        with mock.patch.object(spoofy, "prefetch_organization") as prefetch:
+            scheduled = list(spoofy.schedule_domains(domains, group_window=3))
+        prefetch.assert_called_once_with("example.com")
+        self.assertEqual(
+            scheduled,
+            ["a.example.com", "b.example.com", "other.org", "example.com", "c.x.io"],
+        )
+
+    def test_failed_prefetch_keeps_the_group(self):
+        domains = ["a.example.com", "b.example.com", "other.org"]
+        with mock.patch.object(
+            spoofy, "prefetch_organization", side_effect=TypeError("broken")
+        ):
+            scheduled = list(spoofy.schedule_domains(domains, group_window=3))
+        self.assertEqual(scheduled, domains)
+
+        async def schedule():
+            return [domain async for domain in spoofy.schedule_domains_async(domains, 3)]
+
+        with mock.patch.object(
+            spoofy, "prefetch_organization_async", side_effect=TypeError("broken")
+        ):
+            self.assertEqual(asyncio.run(schedule()), domains)
+
+
+class TestAnswerCache(unittest.TestCase):
+    def test_answers_of_one_server_are_not_served_for_another(self):
+        # The SOA server publishes SPF but no DMARC; the recursive resolver has both.
+        soa_server = start_stub(
+            self, {("example.com", "TXT"): ['"v=spf1 -all"']}, address="127.0.0.1"
+        )
+        start_stub(
+            self,
+            {
+                ("example.com", "SOA"): [
+                    "ns.example.com. hostmaster.example.com. 1 7200 3600 1209600 300"
+                ],
+                ("ns.example.com", "A"): ["127.0.0.1"],
+                ("example.com", "TXT"): ['"v=spf1 -all"'],
+                ("_dmarc.example.com", "TXT"): ['"v=DMARC1; p=reject"'],
+            },
+            port=soa_server.port,
+            address="127.0.0.2",
+        )
+        reset_resolver(self, port=soa_server.port, resolvers=["127.0.0.2"])
+        result = spoofy.process_domain("example.com")
+
+        self.assertEqual(result["DNS_SERVER"], "127.0.0.2")
+        self.assertEqual(result["DMARC_POLICY"], "reject")
+        self.assertFalse(result["SPOOFING_POSSIBLE"])
+
+    def test_repeated_lookups_are_answered_from_the_cache(self):
+        records, domains = build_zones(20)
+        stub = start_stub(self, records)
+        reset_resolver(self, nameservers=["127.0.0.1"], port=stub.port)
+
+        first = [spoofy.process_domain(domain) for domain in domains]
+        queries = stub.queries
+        # Without the memoized SPF trees, every lookup of the second pass goes to the cache.
+        spf._spf_trees.clear()
+        second = [spoofy.process_domain(domain) for domain in domains]
+
+        self.assertEqual(stub.queries, queries)
+        self.assertEqual([result["DNS_QUERIES"] for result in second], [0] * 20)
+        for result in first + second:
+            del result["DNS_QUERIES"], result["DNS_MIN_TTL"]
+        self.assertEqual(second, first)
+
+
+class TestScans(unittest.TestCase):
+    def setUp(self):
+        self.records, self.domains = build_zones(30)
+        self.stub = start_stub(self, self.records)
+        reset_resolver(self, nameservers=["127.0.0.1"], port=self.stub.port)
+
+    def scan(self, run):
+        """Runs a scan with an empty cache and returns its results by domain."""
+        results = []
+        spf._spf_trees.clear()
+        with mock.patch.object(resolver, "answer_cache", resolver.AnswerCache(10000)):
+            run(mock.Mock(write=results.append))
+        return {result["DOMAIN"]: result for result in results}
+
+    def test_queries_are_counted_per_domain(self):
+        # Organizations without subdomains share no records but their SPF includes.
+        domains = [domain for domain in self.domains if domain.startswith("bench-")]
+        alone = {}
+        for domain in domains:
+            queries = self.stub.queries
+            result = self.scan(
+                lambda writer, domain=domain: writer.write(
+                    spoofy.process_domain(domain)
+                )
+            )
+            self.assertEqual(result[domain]["DNS_QUERIES"], self.stub.queries - queries)
+            alone[domain] = result[domain]["DNS_QUERIES"]
+
+        queries = self.stub.queries
+        results = self.scan(
+            lambda writer: spoofy.run_threads(iter(domains), writer, thread_count=8)
+        )
+        self.assertEqual(
+            sum(result["DNS_QUERIES"] for result in results.values()),
+            self.stub.queries - queries,
+        )
+        for domain in domains:
+            self.assertLessEqual(results[domain]["DNS_QUERIES"], alone[domain])
+
+    def test_engines_give_the_same_results(self):
+        threaded = self.scan(
+            lambda writer: spoofy.run_threads(
+                iter(self.domains), writer, thread_count=8
+            )
+        )
+        asynchronous = self.scan(
+            lambda writer: asyncio.run(
+                spoofy.run_async(iter(self.domains), writer, concurrency=8)
+            )
+        )
+        self.assertEqual(sorted(threaded), sorted(self.domains))
+        for results in (threaded, asynchronous):
+            for result in results.values():
+                # Queries move between domains with the order in which they finish.
+                del result["DNS_QUERIES"], result["DNS_MIN_TTL"]
+        self.assertEqual(asynchronous, threaded)
+
+    def test_async_engine_reports_failed_domains(self):
+        domains = ["bad.example", *self.domains[:3]]
+        process_domain_async = spoofy.process_domain_async
+
+        async def process(domain, **kwargs):
+            if domain == "bad.example":
+                raise TypeError("broken")
+            return await process_domain_async(domain, **kwargs)
+
+        failures = []
+        with mock.patch.object(spoofy, "process_domain_async", process), mock.patch(
+            "sys.stderr", io.StringIO()
+        ):
+            results = self.scan(
+                lambda writer: failures.append(
+                    asyncio.run(spoofy.run_async(iter(domains), writer, concurrency=2))
+                )
+            )
+        self.assertEqual(failures, [1])
+        self.assertEqual(sorted(results), sorted(domains))
+        self.assertIsNone(results["bad.example"]["SPOOFING_POSSIBLE"])
+        self.assertIn("TypeError", results["bad.example"]["SPOOFING_TYPE"])
+
+    def test_thread_engine_keeps_consuming_after_a_failure(self):
+        domains = [f"bad{index}.example" for index in range(20)] + self.domains[:3]
+        process_domain = spoofy.process_domain
+
+        def process(domain, **kwargs):
+            if domain.startswith("bad"):
+                raise TypeError("broken")
+            return process_domain(domain, **kwargs)
+
+        failures = []
+        with mock.patch.object(spoofy, "process_domain", process), mock.patch(
+            "sys.stderr", io.StringIO()
+        ):
+            # More failures than threads and queue slots would hang if workers died.
+            results = self.scan(
+                lambda writer: failures.append(
+                    spoofy.run_threads(iter(domains), writer, thread_count=2)
+                )
+            )
+        self.assertEqual(failures, [20])
+        self.assertEqual(sorted(results), sorted(domains))
+        for domain in self.domains[:3]:
+            self.assertNotIn(
+                spoofing.SCAN_FAILED_SPOOFING_TYPE, results[domain]["SPOOFING_TYPE"]
+            )
+
+    def test_thread_engine_stops_when_the_input_fails(self):
+        def domains():
+            yield from self.domains[:3]
+            raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+
+        # run_threads returns only once its workers have been stopped and joined.
+        results = self.scan(
+            lambda writer: self.assertRaises(
+                UnicodeDecodeError,
+                spoofy.run_threads,
+                domains(),
+                writer,
+                thread_count=2,
+            )
+        )
+        self.assertEqual(sorted(results), sorted(self.domains[:3]))
+
+    def test_missing_input_file_is_reported_before_scanning(self):
+        with mock.patch.object(
+            sys, "argv", ["spoofy.py", "-iL", "/nonexistent/domains.txt"]
+        ), mock.patch("sys.stderr", io.StringIO()) as stderr, mock.patch.object(
+            spoofy, "run_threads"
+        ) as run_threads, self.assertRaises(SystemExit):
+            spoofy.main()
+        run_threads.assert_not_called()
+        self.assertIn("cannot open -iL file", stderr.getvalue())
+
+
+class TestResultStore(unittest.TestCase):
+    def test_fresh_results_and_change_tracking(self):
+        store = ResultStore(":memory:")
+        result = {"DOMAIN": "example.com", "SPF": "v=spf1 -all", "DNS_QUERIES": 3}
+        store.save(result)
+        self.assertEqual(store.get_fresh("example.com", 3600)["SPF"], "v=spf1 -all")
+        self.assertEqual(store.get_fresh("example.com", 3600)["DNS_QUERIES"], 0)
+        self.assertIsNone(store.get_fresh("example.com", -1))
+        self.assertIsNone(store.get_fresh("other.com", 3600))
+
+        changed_at = store.connection.execute(
+            "SELECT changed_at FROM results"
+        ).fetchone()
+        store.save(result)
+        self.assertEqual(
+            store.connection.execute("SELECT changed_at FROM results").fetchone(),
+            changed_at,
+        )
+        store.save({**result, "SPF": "v=spf1 ~all"})
+        self.assertEqual(store.get_fresh("example.com", 3600)["SPF"], "v=spf1 ~all")
+        store.close()
+
+    def test_verdict_changes_with_the_same_records_are_stored(self):
+        store = ResultStore(":memory:")
+        self.addCleanup(store.close)
+        result = {
+            "DOMAIN": "example.com",
+            "SPF": "v=spf1 include:provider.example ~all",
+            "SPF_MULTIPLE_ALLS": "~all",
+            "SPOOFING_TYPE": "old verdict",
+        }
+        store.save(result)
+        changed_at = store.connection.execute(
+            "SELECT changed_at FROM results"
+        ).fetchone()
+        store.save(
+            {**result, "SPF_MULTIPLE_ALLS": "-all", "SPOOFING_TYPE": "new verdict"}
+        )
+
+        fresh = store.get_fresh("example.com", 3600)
+        self.assertEqual(fresh["SPOOFING_TYPE"], "new verdict")
+        self.assertEqual(fresh["SPF_MULTIPLE_ALLS"], "-all")
+        self.assertEqual(
+            store.connection.execute("SELECT spoofing_type FROM results").fetchone(),
+            ("new verdict",),
+        )
+        self.assertNotEqual(
+            store.connection.execute("SELECT changed_at FROM results").fetchone(),
+            changed_at,
+        )
+
+
 if __name__ == "__main__":
     unittest.main()